@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# vi: set et sts=4 sw=4 ts=4 :
+
+# benchmark of kvm_image_adjuster.py against the in-memory guest of
+# fake_guestfs.py: no KVM or libguestfs appliance is needed.
+# runs the real adjust paths (interfaces, udev, hostname, resolver, XML,
+# serial console) for RHEL 6 and Ubuntu 12.04 guests with 1, 4 and 16 NICs,
+# single and batched, and reports guestfs calls, mounts and wall time per clone,
+# then the same guests configured with --network-layout (the NICs as with
+# --interface, and bonded in pairs with a VLAN and a bridge on each bond),
+# then a batch of clones sharing filesystem UUIDs (each mounted from its own
+# drive of the shared appliance), then a rollback with and without a working
+# setfiles, then the time to write the domain XMLs of --xml-clones clones
+# from one template. exits non-zero if a clone's image doesn't get its
+# hostname, or a rollback doesn't restore the golden image.
+#
+# usage:
+# ./bench/bench_adjuster.py [--latency MSEC] [--launch-latency MSEC] [--parse-latency MSEC] [--mount-latency MSEC] [--filesystems MOUNTPOINTS] [--etc-files N] [--clones N] [--xml-clones N]
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_guestfs
+sys.modules['guestfs'] = fake_guestfs
+import kvm_image_adjuster as adjuster
+
+domain_xml = """<domain type='kvm'>
+  <name>golden</name>
+  <uuid>00000000-0000-0000-0000-000000000000</uuid>
+  <memory>1048576</memory>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='raw'/>
+      <source file='/var/lib/libvirt/images/golden.img'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+%s  </devices>
+</domain>
+"""
+
+interface_xml = """    <interface type='network'>
+      <mac address='%s'/>
+      <source network='default'/>
+      <model type='virtio'/>
+    </interface>
+"""
+
+def make_layout(nics, layout):
+    # "flat": the addresses of make_jobs() on the NICs; "bond": NICs bonded
+    # in pairs, a VLAN on each bond and a bridge with the address on each VLAN
+    interfaces = []
+    for i in range(nics):
+        iface = {'name': "eth%d" % i, 'type': "ethernet", 'mac': fake_guestfs.mac(i)}
+        if layout == "flat":
+            iface.update(ipaddr="10.0.%d.10" % i, netmask="255.255.0.0")
+        else:
+            iface['master'] = "bond%d" % (i // 2)
+        interfaces.append(iface)
+    if layout == "bond":
+        for b in range((nics + 1) // 2):
+            interfaces += [{'name': "bond%d" % b, 'type': "bond"},
+                           {'name': "bond%d.%d" % (b, 100 + b), 'type': "vlan", 'bridge': "br%d" % b},
+                           {'name': "br%d" % b, 'type': "bridge", 'ipaddr': "10.0.%d.10" % b, 'netmask': "255.255.0.0"}]
+    return {'interfaces': interfaces, 'primary': "eth0" if layout == "flat" else "br0", 'gateway': "10.0.0.1"}
+
+def make_jobs(workdir, nics, clones, layout=None):
+    parser = adjuster.build_option_parser()
+    interfaces = ",".join(["eth%d/auto/10.0.%d.%d/255.255.0.0" % (i, i, 10) for i in range(nics)])
+    xml = domain_xml % "".join([interface_xml % fake_guestfs.mac(i) for i in range(nics)])
+    if layout:
+        layoutpath = os.path.join(workdir, "layout.json")
+        json.dump(make_layout(nics, layout), open(layoutpath, 'w'))
+        network = ["--network-layout=" + layoutpath]
+    else:
+        network = ["--interface=" + interfaces, "--primary=eth0", "--gateway=10.0.0.1"]
+    jobs = []
+    for n in range(clones):
+        xmlpath = os.path.join(workdir, "vm%03d.xml" % n)
+        open(xmlpath, 'w').write(xml)
+        (options, args) = parser.parse_args([
+            "--image=" + os.path.join(workdir, "vm%03d.img" % n), "--xml=" + xmlpath] + network + [
+            "--hostname=vm%03d.example.com" % n, "--nameserver=8.8.8.8,8.8.4.4",
+            "--domain=dept.example.com,example.com", "--serial-console"])
+        jobs.append(vars(options))
+    return jobs
+
+def run(guest, nics, clones, batch_drives, layout=None):
+    fake_guestfs.config['guest'] = guest
+    fake_guestfs.config['nics'] = nics
+    workdir = tempfile.mkdtemp(prefix="bench_adjuster.")
+    jobs = make_jobs(workdir, nics, clones, layout)
+    prof = adjuster.gflags['profile'] = adjuster.profiler()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        results = adjuster.adjust_batch(jobs, batch_drives)
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(workdir)
+    elapsed = time.time() - start
+    failed = [r for r in results if r['status'] != 'ok']
+    if failed:
+        raise RuntimeError("%s: %s" % (failed[0]['imgpath'], failed[0]['error']))
+    for job in jobs:
+        # each clone must have been adjusted in its own image, not another one
+        text = fake_guestfs.images.pop(job['imgpath']).text
+        if job['hostname'].split(".")[0] not in text.get("/etc/hostname", text.get("/etc/sysconfig/network", "")):
+            raise RuntimeError("%s: hostname %s not set" % (job['imgpath'], job['hostname']))
+    calls = prof.calls
+    return {
+        'calls': sum([stat['count'] for stat in calls.values()]) / float(clones),
+        'aug_save': calls.get('aug_save', {'count': 0})['count'] / float(clones),
+        'mount': calls.get('mount', {'count': 0})['count'] / float(clones),
+        'launch': calls.get('launch', {'count': 0})['count'],
+        'wall': elapsed / clones,
+    }
+
+def run_rollback(guest, setfiles_fails):
+    # adjusts a clone, then rolls it back; the undo journal must be
+    # relabelled with the files it undoes, and be gone after the rollback
+    fake_guestfs.config['guest'] = guest
+    fake_guestfs.config['nics'] = 4
+    workdir = tempfile.mkdtemp(prefix="bench_adjuster.")
+    job = make_jobs(workdir, 4, 1)[0]
+    golden = dict(fake_guestfs.guest(guest, 4, fake_guestfs.config['etc_files']).text)
+    adjuster.gflags['profile'] = None
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        adjuster.adjust_single_image(job)
+        image = fake_guestfs.images[job['imgpath']]
+        journals = [path for path in image.text if path.startswith(adjuster.JOURNAL_DIR + "/")]
+        fake_guestfs.config['setfiles_fails'] = setfiles_fails
+        g = adjuster.guestfs_open(job['imgpath'], ['rollback'], use_base=False)
+        adjuster.guestfs_rollback(g, adjuster.guestfs_journals(g)[-1])
+        adjuster.guestfs_close(g)
+    finally:
+        fake_guestfs.config['setfiles_fails'] = False
+        sys.stdout = stdout
+        shutil.rmtree(workdir)
+    image = fake_guestfs.images.pop(job['imgpath'])
+    text = image.text
+    setfiles = [c for c in image.commands if c.startswith("setfiles ")]
+    if len(journals) != 1:
+        raise RuntimeError("%s: %d undo journal(s) written" % (guest, len(journals)))
+    if guest == "rhel6" and not [c for c in setfiles if adjuster.JOURNAL_DIR in c]:
+        raise RuntimeError("%s: undo journal not relabelled" % guest)
+    if journals[0] in text:
+        raise RuntimeError("%s: undo journal left after rollback" % guest)
+    changed = [path for path in golden if text.get(path) != golden[path]]
+    if changed:
+        raise RuntimeError("%s: not rolled back: %s" % (guest, ", ".join(changed)))
+    return "/.autorelabel" in text
+
+def run_xml(clones, nics):
+    workdir = tempfile.mkdtemp(prefix="bench_adjuster.")
+    try:
+        golden = os.path.join(workdir, "golden.xml")
+        open(golden, 'w').write(domain_xml % "".join([interface_xml % fake_guestfs.mac(i) for i in range(nics)]))
+        start = time.time()
+        template = adjuster.domain_template.load(golden)
+        for n in range(clones):
+            macs = [fake_guestfs.mac(n * nics + i + nics) for i in range(nics)]
+            adjuster.write_file_atomic(os.path.join(workdir, "vm%03d.xml" % n),
+                                       template.render("vm%03d" % n, image=os.path.join(workdir, "vm%03d.img" % n),
+                                                       uuid="00000000-0000-0000-0000-%012d" % n, macs=macs,
+                                                       format="qcow2"))
+        return time.time() - start
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [--latency MSEC] [--launch-latency MSEC] [--parse-latency MSEC] [--mount-latency MSEC] [--filesystems MOUNTPOINTS] [--etc-files N] [--clones N] [--xml-clones N]")
+    parser.add_option("--latency", action="store", type="float", dest="latency", default=1.0, help="simulated round trip per guestfs call in msec (default: 1.0)")
+    parser.add_option("--launch-latency", action="store", type="float", dest="launch_latency", default=0.0, help="simulated appliance boot in msec (default: 0)")
+    parser.add_option("--parse-latency", action="store", type="float", dest="parse_latency", default=0.5, help="simulated augeas parse time per loaded file in msec (default: 0.5)")
+    parser.add_option("--mount-latency", action="store", type="float", dest="mount_latency", default=20.0, help="simulated mount (journal replay) per filesystem in msec (default: 20)")
+    parser.add_option("--filesystems", action="store", type="string", dest="filesystems", default="/boot,/var,/home,/opt,/srv/data", help="mount points of separate filesystems besides / in the guests (default: /boot,/var,/home,/opt,/srv/data)")
+    parser.add_option("--etc-files", action="store", type="int", dest="etc_files", default=200, help="number of unrelated config files in the guest (default: 200)")
+    parser.add_option("--clones", action="store", type="int", dest="clones", default=16, help="number of clones in the batch runs (default: 16)")
+    parser.add_option("--xml-clones", action="store", type="int", dest="xml_clones", default=500, help="number of domain XMLs written from one template (default: 500)")
+    (options, args) = parser.parse_args()
+    fake_guestfs.config['latency'] = options.latency / 1000.0
+    fake_guestfs.config['launch_latency'] = options.launch_latency / 1000.0
+    fake_guestfs.config['parse_latency'] = options.parse_latency / 1000.0
+    fake_guestfs.config['mount_latency'] = options.mount_latency / 1000.0
+    fake_guestfs.config['filesystems'] = [mp for mp in options.filesystems.split(",") if mp]
+    fake_guestfs.config['etc_files'] = options.etc_files
+
+    print "%-10s %5s %7s %7s %12s %10s %13s %13s" % ("guest", "nics", "clones", "drives", "calls/clone", "saves/clone",
+                                                    "mounts/clone", "msec/clone")
+    for guest in ("rhel6", "ubuntu12"):
+        for nics in (1, 4, 16):
+            for (clones, batch_drives) in ((1, 1), (options.clones, 8)):
+                r = run(guest, nics, clones, batch_drives)
+                print "%-10s %5d %7d %7d %12.1f %10.1f %13.1f %13.1f" % (guest, nics, clones, batch_drives,
+                                                                         r['calls'], r['aug_save'], r['mount'],
+                                                                         r['wall'] * 1000)
+
+    print
+    print "%-10s %5s %7s %12s %10s %13s" % ("guest", "nics", "layout", "calls/clone", "saves/clone", "msec/clone")
+    for guest in ("rhel6", "ubuntu12"):
+        for nics in (4, 16, 64):
+            for layout in (None, "flat", "bond"):
+                r = run(guest, nics, options.clones, 8, layout)
+                print "%-10s %5d %7s %12.1f %10.1f %13.1f" % (guest, nics, layout or "-", r['calls'], r['aug_save'],
+                                                            r['wall'] * 1000)
+
+    print
+    fake_guestfs.config['shared_uuids'] = True
+    for guest in ("rhel6", "ubuntu12"):
+        r = run(guest, 4, options.clones, 8)
+        print "%s: %d clones sharing filesystem UUIDs: %d launch(es), %.1f msec/clone" % (guest, options.clones,
+                                                                                      r['launch'], r['wall'] * 1000)
+    fake_guestfs.config['shared_uuids'] = False
+
+    for guest in ("rhel6", "ubuntu12"):
+        for setfiles_fails in (False, True):
+            autorelabel = run_rollback(guest, setfiles_fails)
+            print "%s: rollback%s: ok%s" % (guest, " (setfiles failing)" if setfiles_fails else "",
+                                           ", relabel on next boot" if autorelabel else "")
+
+    for nics in (1, 16):
+        elapsed = run_xml(options.xml_clones, nics)
+        print "xml: %d clones with %d NIC(s) from one template in %.1f msec" % (options.xml_clones, nics, elapsed * 1000)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# vi: set et sts=4 sw=4 ts=4 :
+
+# startup benchmark of kvm_image_adjuster.py: wall time of whole invocations
+# (interpreter start, imports, option parsing) for paths that must stay light,
+# and the heavy modules each of them loads. "--help" must not load lxml or
+# libguestfs, "--mode=seed" (XML and seed ISO only) must not load libguestfs,
+# and nothing loads virtinst. exits non-zero if one does, so it can run in CI;
+# libguestfs doesn't need to be installed.
+#
+# usage:
+# ./bench/bench_startup.py [--runs N]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "kvm_image_adjuster.py")
+
+heavy = ["guestfs", "lxml.etree", "virtinst", "libvirt", "augeas", "multiprocessing", "ctypes"]
+
+# runs the script as __main__ and records the heavy modules loaded at exit
+probe = """
+import sys, atexit
+def report():
+    open(%r, 'w').write(" ".join([m for m in %r if m in sys.modules]))
+atexit.register(report)
+sys.argv = %r
+execfile(sys.argv[0], {'__name__': '__main__'})
+"""
+
+domain_xml = """<domain type='kvm'>
+  <name>golden</name>
+  <uuid>00000000-0000-0000-0000-000000000000</uuid>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='raw'/>
+      <source file='/var/lib/libvirt/images/golden.img'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <interface type='network'>
+      <mac address='52:54:00:00:00:01'/>
+      <source network='default'/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+def cases(workdir):
+    xmlpath = os.path.join(workdir, "vm.xml")
+    seed = ["--mode=seed", "--image=" + os.path.join(workdir, "vm.img"), "--xml=" + xmlpath,
+            "--interface=eth0/auto/10.0.0.10/255.255.255.0", "--primary=eth0", "--gateway=10.0.0.1",
+            "--hostname=vm.example.com", "--nameserver=8.8.8.8",
+            "--state=" + os.path.join(workdir, "state.json"), "--xml-dir=" + workdir]
+    # (name, argv, forbidden modules)
+    return [("python", None, []),
+            ("--help", ["--help"], ["guestfs", "lxml.etree", "virtinst"]),
+            ("seed", seed, ["guestfs", "virtinst"])]
+
+def reset(workdir):
+    for name in os.listdir(workdir):
+        os.unlink(os.path.join(workdir, name))
+    open(os.path.join(workdir, "vm.xml"), 'w').write(domain_xml)
+
+def run(argv, devnull):
+    start = time.time()
+    ret = subprocess.call(argv, stdout=devnull, stderr=devnull)
+    elapsed = time.time() - start
+    if ret != 0:
+        raise RuntimeError("%s exited with %d" % (" ".join(argv), ret))
+    return elapsed
+
+def loaded(workdir, args):
+    out = tempfile.mktemp(prefix="bench_startup.")
+    try:
+        devnull = open(os.devnull, 'w')
+        subprocess.call([sys.executable, "-c", probe % (out, heavy, [script] + args)],
+                        stdout=devnull, stderr=devnull)
+        return open(out).read().split()
+    finally:
+        if os.path.exists(out): os.unlink(out)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [--runs N]")
+    parser.add_option("--runs", action="store", type="int", dest="runs", default=20, help="invocations per case (default: 20)")
+    (options, args) = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_startup.")
+    devnull = open(os.devnull, 'w')
+    failed = False
+    print "%-8s %9s %9s  %s" % ("case", "min msec", "med msec", "heavy modules loaded")
+    try:
+        for (name, args, forbidden) in cases(workdir):
+            argv = [sys.executable, "-c", "pass"] if args is None else [sys.executable, script] + args
+            times = []
+            for i in range(options.runs):
+                reset(workdir)
+                times.append(run(argv, devnull))
+            times.sort()
+            modules = []
+            if args is not None:
+                reset(workdir)
+                modules = loaded(workdir, args)
+            bad = [m for m in modules if m in forbidden]
+            failed = failed or bool(bad)
+            print "%-8s %9.1f %9.1f  %s%s" % (name, times[0] * 1000, times[len(times) // 2] * 1000,
+                                             " ".join(modules) or "-",
+                                             "  ** must not load: " + " ".join(bad) if bad else "")
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(1 if failed else 0)
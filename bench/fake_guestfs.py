@@ -0,0 +1,530 @@
+# vi: set et sts=4 sw=4 ts=4 :
+
+# in-memory stand-in for the guestfs module, for benchmarking
+# kvm_image_adjuster.py without KVM or a libguestfs appliance.
+#
+# every GuestFS method sleeps config['latency'] seconds to simulate an
+# appliance round trip; launch() additionally sleeps config['launch_latency'],
+# and every file parsed by aug_load() config['parse_latency'].
+# config['filesystems'] adds mount points on separate filesystems (e.g. /var,
+# /home, data volumes) to every guest, each mount() sleeping config['mount_latency'].
+# with config['shared_uuids'], the guests are clones sharing filesystem UUIDs:
+# as with findfs, their fstab entries resolve to the partitions of the first
+# drive of the appliance. mounting a partition of another drive below the
+# root filesystem fails, so that a clone never gets another clone's /var.
+# with config['setfiles_fails'], sh() fails for setfiles, as it does when
+# the policy can't be used in the appliance.
+# the guest images are RHEL 6 or Ubuntu 12.04 trees built by make_guest().
+# files with a lens in lenses are kept in real syntax and re-parsed when
+# written directly (write, tar_in), as augeas would on the next load.
+
+import re
+import os
+import tarfile
+import hashlib
+import time
+import copy
+import fnmatch
+import StringIO
+
+config = {
+    'latency': 0.0,
+    'launch_latency': 0.0,
+    'parse_latency': 0.0,
+    'mount_latency': 0.0,
+    'filesystems': [],
+    'shared_uuids': False,
+    'guest': 'rhel6',
+    'nics': 1,
+    'etc_files': 0,
+    'setfiles_fails': False,
+}
+
+# the guest of every image file added, kept across appliances
+images = {}
+
+def mac(i):
+    return "52:54:00:00:%02x:%02x" % (i / 256, i % 256)
+
+def shellvars(d):
+    return [(k, v, []) for (k, v) in d]
+
+def make_rhel6(nics, etc_files):
+    aug = {}
+    text = {}
+    for i in range(nics):
+        aug["/etc/sysconfig/network-scripts/ifcfg-eth%d" % i] = shellvars([
+            ("DEVICE", '"eth%d"' % i), ("BOOTPROTO", '"dhcp"'), ("HWADDR", '"%s"' % mac(i).upper()),
+            ("NM_CONTROLLED", '"yes"'), ("ONBOOT", '"yes"'), ("TYPE", '"Ethernet"'),
+            ("UUID", '"00000000-0000-0000-0000-%012d"' % i)])
+    aug["/etc/sysconfig/network-scripts/ifcfg-lo"] = shellvars([("DEVICE", "lo"), ("IPADDR", "127.0.0.1")])
+    aug["/etc/sysconfig/network"] = shellvars([("NETWORKING", "yes"), ("HOSTNAME", "golden.example.com")])
+    aug["/etc/resolv.conf"] = [("nameserver", "192.168.0.1", []), ("search", None, [("domain", "example.com", [])])]
+    aug["/boot/grub/menu.lst"] = [
+        ("default", "0", []), ("timeout", "5", []), ("splashimage", "(hd0,0)/grub/splash.xpm.gz", []),
+        ("hiddenmenu", None, []),
+        ("title", "Red Hat Enterprise Linux (2.6.32-279.el6.x86_64)", [
+            ("root", "(hd0,0)", []),
+            ("kernel", "/vmlinuz-2.6.32-279.el6.x86_64", [
+                ("ro", None, []), ("root", "/dev/mapper/vg_golden-lv_root", []),
+                ("rhgb", None, []), ("quiet", None, [])]),
+            ("initrd", "/initramfs-2.6.32-279.el6.x86_64.img", [])])]
+    aug["/etc/inittab"] = [("#comment", "inittab is only used by upstart for the default runlevel.", []),
+                           ("id", None, [("runlevels", "5", []), ("action", "initdefault", []), ("process", None, [])])]
+    for i in range(etc_files):
+        aug["/etc/sysconfig/misc%d" % i] = shellvars([("KEY%d" % j, "value%d" % j) for j in range(20)])
+    text["/etc/udev/rules.d/70-persistent-net.rules"] = "".join([
+        'SUBSYSTEM=="net", ACTION=="add", DRIVERS=="?*", ATTR{address}=="%s", ATTR{type}=="1", KERNEL=="eth*", NAME="eth%d"\n'
+        % (mac(i), i) for i in range(nics)])
+    text["/etc/init/start-ttys.conf"] = ("start on stopped rc RUNLEVEL=[2345]\n\nenv ACTIVE_CONSOLES=/dev/tty[1-6]\n"
+                                         "env X_TTY=/dev/tty1\ntask\nscript\n\t. /etc/sysconfig/init\nend script\n")
+    text["/etc/selinux/config"] = "SELINUX=enforcing\nSELINUXTYPE=targeted\n"
+    text["/etc/selinux/targeted/contexts/files/file_contexts"] = "/.*\tsystem_u:object_r:default_t:s0\n"
+    text["/etc/redhat-release"] = "Red Hat Enterprise Linux Server release 6.3 (Santiago)\n"
+    inspect = {'type': 'linux', 'distro': 'rhel', 'major': 6, 'minor': 3,
+               'product': "Red Hat Enterprise Linux Server release 6.3 (Santiago)", 'hostname': "golden.example.com"}
+    return (aug, text, inspect)
+
+def make_ubuntu12(nics, etc_files):
+    aug = {}
+    text = {}
+    ifaces = [("auto", None, [("1", "lo", [])]),
+              ("iface", "lo", [("family", "inet", []), ("method", "loopback", [])])]
+    for i in range(nics):
+        ifaces += [("auto", None, [("1", "eth%d" % i, [])]),
+                   ("iface", "eth%d" % i, [("family", "inet", []), ("method", "dhcp", [])])]
+    aug["/etc/network/interfaces"] = ifaces
+    for i in range(etc_files):
+        aug["/etc/default/misc%d" % i] = shellvars([("KEY%d" % j, "value%d" % j) for j in range(20)])
+    text["/etc/hostname"] = "golden\n"
+    text["/etc/default/grub"] = ('GRUB_DEFAULT=0\nGRUB_HIDDEN_TIMEOUT=0\nGRUB_TIMEOUT=2\n'
+                                 'GRUB_DISTRIBUTOR=`lsb_release -i -s 2> /dev/null || echo Debian`\n'
+                                 'GRUB_CMDLINE_LINUX_DEFAULT="quiet splash"\nGRUB_CMDLINE_LINUX=""\n')
+    text["/etc/udev/rules.d/70-persistent-net.rules"] = "".join([
+        'SUBSYSTEM=="net", ACTION=="add", DRIVERS=="?*", ATTR{address}=="%s", ATTR{dev_id}=="0x0", ATTR{type}=="1", KERNEL=="eth*", NAME="eth%d"\n'
+        % (mac(i), i) for i in range(nics)])
+    text["/etc/lsb-release"] = "DISTRIB_ID=Ubuntu\nDISTRIB_RELEASE=12.04\n"
+    inspect = {'type': 'linux', 'distro': 'ubuntu', 'major': 12, 'minor': 4,
+               'product': "Ubuntu 12.04 LTS", 'hostname': "golden"}
+    return (aug, text, inspect)
+
+guest_builders = {
+    'rhel6': make_rhel6,
+    'ubuntu12': make_ubuntu12,
+}
+
+class guest:
+    def __init__(self, name, nics, etc_files):
+        (self.aug, self.text, self.inspect) = guest_builders[name](nics, etc_files)
+        self.commands = []
+        for path in self.aug:
+            self.text[path] = render(path, self.aug[path])
+
+    def write(self, path, content):
+        self.text[path] = content
+        lens = find_lens(path)
+        if lens: self.aug[path] = lens[1](content)
+        else: self.aug.pop(path, None)
+
+    def remove(self, path):
+        del self.text[path]
+        self.aug.pop(path, None)
+
+def render_tree(spec, prefix=""):
+    # files without a lens here: one "path=value" line per node
+    lines = []
+    for (label, value, children) in spec:
+        lines.append("%s%s=%s\n" % (prefix, label, value if value is not None else ""))
+        lines += render_tree(children, prefix + label + "/")
+    return "".join(lines)
+
+def render_shellvars(spec):
+    return "".join(["%s=%s\n" % (label, value or "") for (label, value, children) in spec])
+
+def parse_shellvars(content):
+    return [(m.group(1), m.group(2), []) for m in re.finditer(r"(?m)^\s*([A-Za-z_][A-Za-z0-9_]*)=(.*)$", content)]
+
+def render_interfaces(spec):
+    lines = []
+    for (label, value, children) in spec:
+        if label in ("auto", "allow-hotplug"):
+            lines.append(" ".join([label] + [v for (l, v, c) in children]) + "\n")
+        elif label == "iface":
+            options = dict([(l, v) for (l, v, c) in children])
+            lines.append("iface %s %s %s\n" % (value, options.get("family"), options.get("method")))
+            lines += ["    %s %s\n" % (l, v) for (l, v, c) in children if l not in ("family", "method")]
+    return "".join(lines)
+
+def parse_interfaces(content):
+    spec = []
+    for line in content.splitlines():
+        words = line.split(None, 1)
+        if not words or words[0].startswith("#"): continue
+        if words[0] in ("auto", "allow-hotplug"):
+            spec.append((words[0], None, [(str(i + 1), v, []) for (i, v) in enumerate(words[1].split())]))
+        elif words[0] == "iface":
+            (name, family, method) = words[1].split()
+            spec.append(("iface", name, [("family", family, []), ("method", method, [])]))
+        elif spec and spec[-1][0] == "iface":
+            spec[-1][2].append((words[0], words[1].strip() if len(words) > 1 else None, []))
+    return spec
+
+# (glob, parse, render) of the files kept in real syntax
+lenses = [
+    ("/etc/sysconfig/*", parse_shellvars, render_shellvars),
+    ("/etc/network/interfaces", parse_interfaces, render_interfaces),
+]
+
+def find_lens(path):
+    for lens in lenses:
+        if fnmatch.fnmatch(path, lens[0]): return lens
+    return None
+
+def render(path, spec):
+    lens = find_lens(path)
+    return lens[2](spec) if lens else render_tree(spec)
+
+class node:
+    def __init__(self, label, value=None, parent=None):
+        self.label = label
+        self.value = value
+        self.parent = parent
+        self.children = []
+
+    def add(self, label, value=None, index=None):
+        child = node(label, value, self)
+        if index is None: self.children.append(child)
+        else: self.children.insert(index, child)
+        return child
+
+    def path(self):
+        if self.parent is None:
+            return ""
+        same = [c for c in self.parent.children if c.label == self.label]
+        label = self.label
+        if len(same) > 1:
+            label += "[%d]" % (same.index(self) + 1)
+        return self.parent.path() + "/" + label
+
+    def descendants(self):
+        nodes = [self]
+        for c in self.children:
+            nodes += c.descendants()
+        return nodes
+
+    def to_spec(self):
+        return [(c.label, c.value, c.to_spec()) for c in self.children]
+
+SEGMENT = re.compile(r"^([^\[]*)(?:\[(.*)\])?$")
+
+class GuestFS:
+    def __init__(self):
+        self.latency = config['latency']
+        self.drives = []
+        self.labels = {}
+        self.launched = False
+        self.active = None
+        self.aug_root = None
+        self.commands = []
+
+    # drives, launch and inspection
+
+    def set_autosync(self, autosync): pass
+    def set_selinux(self, selinux): pass
+    def sync(self): pass
+    def close(self): pass
+
+    def add_drive_opts(self, filename, readonly=0, label=None, format=None):
+        if filename not in images:
+            images[filename] = guest(config['guest'], config['nics'], config['etc_files'])
+        self.drives.append(images[filename])
+        if label: self.labels[label] = len(self.drives) - 1
+
+    def remove_drive(self, label):
+        self.drives[self.labels.pop(label)] = None
+
+    def launch(self):
+        time.sleep(config['launch_latency'])
+        self.launched = True
+
+    def list_devices(self):
+        return ["/dev/sd%s" % chr(ord('a') + i) for i in range(len(self.drives))]
+
+    def list_partitions(self):
+        return ["%s%d" % (dev, i + 1) for dev in self.list_devices() for i in range(len(config['filesystems']) + 1)]
+
+    def list_filesystems(self):
+        return dict([(part, "ext4") for part in self.list_partitions()])
+
+    def lvs(self): return []
+    def pvs(self): return []
+    def mounts(self): return ["/dev/sd%s1" % chr(ord('a') + self.active)] if self.active is not None else []
+    def mountpoints(self): return dict([(dev, "/") for dev in self.mounts()])
+    def is_lv(self, device): return False
+    def part_to_dev(self, part): return re.sub(r"[0-9]+$", "", part)
+    def part_to_partnum(self, part): return int(re.search(r"[0-9]+$", part).group(0))
+
+    def inspect_os(self):
+        return ["/dev/sd%s1" % chr(ord('a') + i) for (i, d) in enumerate(self.drives) if d is not None]
+
+    def _inspect(self, root):
+        return self.drives[ord(root[len("/dev/sd")]) - ord('a')].inspect
+
+    def inspect_get_type(self, root): return self._inspect(root)['type']
+    def inspect_get_distro(self, root): return self._inspect(root)['distro']
+    def inspect_get_major_version(self, root): return self._inspect(root)['major']
+    def inspect_get_minor_version(self, root): return self._inspect(root)['minor']
+    def inspect_get_product_name(self, root): return self._inspect(root)['product']
+    def inspect_get_hostname(self, root): return self._inspect(root)['hostname']
+    def inspect_get_mountpoints(self, root):
+        if config['shared_uuids']: root = "/dev/sda1"
+        return [("/", root)] + [(mp, "%s%d" % (root[:-1], i + 2)) for (i, mp) in enumerate(config['filesystems'])]
+
+    def mount(self, device, mountpoint):
+        # the files of the other filesystems live in the same tree
+        time.sleep(config['mount_latency'])
+        drive = ord(device[len("/dev/sd")]) - ord('a')
+        if mountpoint == "/":
+            self.active = drive
+        elif drive != self.active:
+            raise RuntimeError("mount: %s is not on the drive of the root filesystem" % device)
+
+    def umount_all(self):
+        self.active = None
+
+    # files
+
+    def _guest(self):
+        if self.active is None:
+            raise RuntimeError("no filesystem is mounted")
+        return self.drives[self.active]
+
+    def exists(self, path):
+        return self.is_file(path) or self.is_dir(path)
+
+    def is_file(self, path):
+        return path in self._guest().text
+
+    def is_dir(self, path):
+        prefix = path.rstrip("/") + "/"
+        return any([p.startswith(prefix) for p in self._guest().text])
+
+    def read_file(self, path):
+        if not self.is_file(path):
+            raise RuntimeError("read_file: %s: No such file or directory" % path)
+        return self._guest().text[path]
+
+    def cat(self, path):
+        return self.read_file(path)
+
+    def read_lines(self, path):
+        return self.read_file(path).splitlines()
+
+    def write(self, path, content):
+        self._guest().write(path, content)
+
+    def touch(self, path):
+        if not self.is_file(path): self._guest().write(path, "")
+
+    def cp_a(self, src, dest):
+        self._guest().write(dest, self.read_file(src))
+
+    def mv(self, src, dest):
+        self._guest().write(dest, self.read_file(src))
+        self._guest().remove(src)
+
+    def rm(self, path):
+        self.read_file(path)
+        self._guest().remove(path)
+
+    def rm_f(self, path):
+        if self.is_file(path): self._guest().remove(path)
+
+    def mkdir_p(self, path): pass
+
+    def ls(self, path):
+        prefix = path.rstrip("/") + "/"
+        return sorted(set([p[len(prefix):].split("/")[0] for p in self._guest().text if p.startswith(prefix)]))
+
+    def tar_out(self, directory, tarpath):
+        prefix = directory.rstrip("/") + "/"
+        tar = tarfile.open(tarpath, 'w')
+        for path in sorted(self._guest().text):
+            if not path.startswith(prefix): continue
+            content = self._guest().text[path]
+            info = tarfile.TarInfo("./" + path[len(prefix):])
+            info.size = len(content)
+            tar.addfile(info, StringIO.StringIO(content))
+        tar.close()
+
+    def tar_in(self, tarpath, directory):
+        tar = tarfile.open(tarpath)
+        for member in tar.getmembers():
+            if member.isfile():
+                self._guest().write(directory.rstrip("/") + "/" + os.path.normpath(member.name),
+                                    tar.extractfile(member).read())
+        tar.close()
+
+    def checksum(self, csumtype, path):
+        return hashlib.new(csumtype, self.read_file(path)).hexdigest()
+
+    def egrep(self, regex, path):
+        return [line for line in self.read_lines(path) if re.search(regex, line)]
+
+    def sh(self, command):
+        self.commands.append(command)
+        self._guest().commands.append(command)
+        if config['setfiles_fails'] and command.startswith("setfiles "):
+            raise RuntimeError("setfiles: SELinux policy not loaded")
+        if command == "update-grub":
+            self.write("/boot/grub/grub.cfg", "# generated by update-grub\n")
+        return ""
+
+    # augeas
+
+    def aug_init(self, root, flags):
+        self.aug_flags = flags
+        self.aug_root = node("")
+        self.aug_files = {}
+        self.aug_dirty = []
+        self.aug_root.add("augeas")
+        self.aug_root.add("files")
+        if not flags & 32:
+            self._aug_load_files(lambda path: True)
+
+    def aug_close(self):
+        self.aug_root = None
+
+    def aug_load(self):
+        xfms = self._aug_nodes("/augeas/load/*")
+        def wanted(path):
+            for xfm in xfms:
+                incl = [c.value for c in xfm.children if c.label == "incl"]
+                excl = [c.value for c in xfm.children if c.label == "excl"]
+                if [1 for p in incl if fnmatch.fnmatch(path, p)] and \
+                   not [1 for p in excl if fnmatch.fnmatch(path.split("/")[-1], p)]:
+                    return True
+            return False
+        self._aug_load_files(wanted)
+
+    def _aug_load_files(self, wanted):
+        g = self._guest()
+        for path in sorted(g.aug):
+            if not wanted(path): continue
+            time.sleep(config['parse_latency'])
+            filenode = self._aug_create("/files" + path)
+            filenode.children = []
+            self._aug_build(filenode, g.aug[path])
+            self.aug_files[filenode] = path
+            self._aug_create("/augeas/files" + path + "/path").value = "/files" + path
+
+    def _aug_build(self, parent, spec):
+        for (label, value, children) in spec:
+            self._aug_build(parent.add(label, value), children)
+
+    def _aug_nodes(self, path):
+        nodes = [self.aug_root]
+        for seg in path.split("/")[1:]:
+            if seg == "":
+                nodes = sum([n.descendants() for n in nodes], [])
+                continue
+            (label, pred) = SEGMENT.match(seg).groups()
+            found = []
+            for n in nodes:
+                kids = [c for c in n.children if label == "*" or c.label == label]
+                if pred is None: found += kids
+                elif pred == "last()": found += kids[-1:]
+                elif pred == "last()+1": pass
+                else:
+                    i = int(pred)
+                    if 0 < i <= len(kids): found.append(kids[i - 1])
+            nodes = found
+        return nodes
+
+    def _aug_one(self, path):
+        nodes = self._aug_nodes(path)
+        if len(nodes) != 1:
+            raise RuntimeError("%s matches %d nodes" % (path, len(nodes)))
+        return nodes[0]
+
+    def _aug_create(self, path):
+        n = self.aug_root
+        for seg in path.split("/")[1:]:
+            (label, pred) = SEGMENT.match(seg).groups()
+            kids = [c for c in n.children if c.label == label]
+            if pred == "last()+1" or not kids:
+                n = n.add(label)
+            elif pred is None:
+                if len(kids) > 1:
+                    raise RuntimeError("%s: too many matches" % path)
+                n = kids[0]
+            elif pred == "last()":
+                n = kids[-1]
+            elif int(pred) == len(kids) + 1:
+                n = n.add(label)
+            elif 0 < int(pred) <= len(kids):
+                n = kids[int(pred) - 1]
+            else:
+                raise RuntimeError("%s: no such node" % path)
+        return n
+
+    def _aug_touch(self, n):
+        while n is not None:
+            if n in self.aug_files:
+                if n not in self.aug_dirty: self.aug_dirty.append(n)
+                return
+            n = n.parent
+
+    def aug_match(self, path):
+        return [n.path() for n in self._aug_nodes(path)]
+
+    def aug_get(self, path):
+        return self._aug_one(path).value
+
+    def aug_set(self, path, value):
+        n = self._aug_create(path)
+        n.value = value
+        self._aug_touch(n)
+
+    def aug_clear(self, path):
+        self.aug_set(path, None)
+
+    def aug_insert(self, path, label, before):
+        n = self._aug_one(path)
+        siblings = n.parent.children
+        index = siblings.index(n) + (0 if before else 1)
+        self._aug_touch(n.parent.add(label, index=index))
+
+    def aug_rm(self, path):
+        nodes = self._aug_nodes(path)
+        for n in nodes:
+            self._aug_touch(n.parent)
+            n.parent.children.remove(n)
+        return len(nodes)
+
+    def aug_save(self):
+        g = self._guest()
+        for n in self._aug_nodes("/augeas/events"):
+            n.parent.children.remove(n)
+        for n in self.aug_dirty:
+            path = self.aug_files[n]
+            if self.aug_flags & 16:
+                self._aug_create("/augeas/events/saved[last()+1]").value = "/files" + path
+                continue
+            if self.aug_flags & 1 and path in g.text:
+                g.text[path + ".augsave"] = g.text[path]
+            g.aug[path] = n.to_spec()
+            g.text[path] = render(path, g.aug[path])
+            self._aug_create("/augeas/events/saved[last()+1]").value = "/files" + path
+        self.aug_dirty = []
+
+def with_latency(func):
+    def call(self, *args, **kwargs):
+        if self.latency: time.sleep(self.latency)
+        return func(self, *args, **kwargs)
+    call.__name__ = func.__name__
+    return call
+
+for name, func in GuestFS.__dict__.items():
+    if callable(func) and not name.startswith("_"):
+        setattr(GuestFS, name, with_latency(func))
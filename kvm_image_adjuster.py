@@ -7,13 +7,29 @@
 import re
 import os
 import sys
+import time
+import copy
+import gzip
+import difflib
+import StringIO
+import hashlib
+import csv
+import errno
+import fcntl
+import shlex
+import json
+import shutil
+import fnmatch
+import tempfile
+import socket
+import struct
+import threading
+import Queue
 import optparse
-import guestfs
-import virtinst.util
+import subprocess
 from pprint import pprint
-from lxml import etree
 
-gflags = {'debug':False, 'os':''}
+gflags = {'debug':False, 'os':'', 'profile':None, 'backend':'guestfs', 'dry_run':False, 'base_ops':[]}
 ifcfgs = {}
 
 AUG_SAVE_BACKUP = 1
@@ -22,6 +38,288 @@ AUG_TYPE_CHECK = 4
 AUG_NO_STDINC = 8
 AUG_SAVE_NOOP = 16
 AUG_NO_LOAD = 32
+AUG_NO_MODL_AUTOLOAD = 64
+
+AUG_EXCL = ["*.augnew", "*.augsave", "*.orig", "*.adjuster_orig", "*.rpmnew", "*.rpmsave", "*.dpkg-*", "*~", "*.bak"]
+
+class profiler:
+    # per-phase wall time and per-method guestfs call counts/latency (--profile).
+    # the stages of the clone pipeline record and merge from several threads
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.calls = {}
+
+    def record(self, table, name, elapsed):
+        with self.lock:
+            stat = table.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            stat['count'] += 1
+            stat['total'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+
+    def take(self):
+        # hands the collected data over (e.g. from a worker to the parent)
+        with self.lock:
+            data = {'phases': self.phases, 'calls': self.calls}
+            self.reset()
+        return data
+
+    def merge(self, data):
+        with self.lock:
+            for key, table in (('phases', self.phases), ('calls', self.calls)):
+                for name, stat in data[key].items():
+                    total = table.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+                    total['count'] += stat['count']
+                    total['total'] += stat['total']
+                    total['max'] = max(total['max'], stat['max'])
+
+    def report(self):
+        report = {'wall': time.time() - self.start, 'phases': self.phases, 'calls': self.calls}
+        for table in (self.phases, self.calls):
+            for stat in table.values():
+                stat['avg'] = stat['total'] / stat['count']
+        return json.dumps(report, indent=2, sort_keys=True)
+
+class profiled_guestfs:
+    def __init__(self, g, prof):
+        self.g = g
+        self.prof = prof
+
+    def __getattr__(self, name):
+        attr = getattr(self.g, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.prof.record(self.prof.calls, name, time.time() - start)
+        return call
+
+def profile_guestfs(g):
+    return profiled_guestfs(g, gflags['profile']) if gflags['profile'] else g
+
+def profile_phase(name):
+    def decorator(func):
+        def timed(*args, **kwargs):
+            if not gflags['profile']:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                gflags['profile'].record(gflags['profile'].phases, name, time.time() - start)
+        return timed
+    return decorator
+
+class aug_transaction_error(RuntimeError):
+    def __init__(self, failed):
+        self.failed = failed
+        RuntimeError.__init__(self, "augeas transaction failed:\n" +
+                              "\n".join(["  %s %s: %s" % f for f in failed]))
+
+# next to the base fingerprint on the root filesystem, so that writing it
+# never needs a separate /var mounted
+JOURNAL_DIR = "/etc/kvm_image_adjuster/journal"
+
+def journal_delta(new, orig):
+    # what turns the lines of new back into orig: [[first, last, lines], ...]
+    a = new.decode('latin-1').splitlines(True)
+    b = orig.decode('latin-1').splitlines(True)
+    return [[i1, i2, b[j1:j2]] for (tag, i1, i2, j1, j2) in
+            difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes() if tag != 'equal']
+
+def journal_undo(new, delta):
+    a = new.decode('latin-1').splitlines(True)
+    lines = []
+    pos = 0
+    for (i1, i2, orig_lines) in delta:
+        lines += a[pos:i1] + orig_lines
+        pos = i2
+    return "".join(lines + a[pos:]).encode('latin-1')
+
+class aug_transaction:
+    # wraps a guestfs handle for one image. augeas modifications go to the
+    # in-memory tree right away (so later aug_match/aug_get see them) and are
+    # recorded; the files are written by a single aug_save() in commit().
+    # setting a node to the value it already has is not a modification, so
+    # an image that is already in the desired state is not saved at all. the
+    # current values are taken from what the adjusters already read in bulk
+    # (aug_known()), and only fetched with aug_get() for other nodes.
+    # the original content of every file written is kept, and write_journal()
+    # stores what undoes the run in one journal file in the guest.
+    def __init__(self, g):
+        self.g = g
+        self.ops = []
+        self.failed = []
+        self.touched = []
+        self.originals = {}
+        self.written = {}
+        self.known = {}
+        self.known_nodes = set()
+
+    def __getattr__(self, name):
+        return getattr(self.g, name)
+
+    def _apply(self, op, path, func, *args):
+        self.ops.append((op, path, args))
+        try:
+            return func(path, *args)
+        except RuntimeError as msg:
+            self.failed.append((op, path, str(msg)))
+
+    def aug_known(self, augpath, values, complete=True):
+        # values {key: value} of the children of augpath, read by the caller
+        # (e.g. parsed from the file). complete: augpath has no other children
+        for (key, value) in values.items():
+            self.known[augpath + "/" + key] = value
+        if complete:
+            self.known_nodes.add(augpath)
+
+    def _forget(self, path):
+        # the tree under and around path changes shape (insert, rm)
+        parent = path.rsplit("/", 1)[0]
+        for known in [k for k in self.known if k.startswith(parent + "/") or k == parent]:
+            del self.known[known]
+        self.known_nodes = set([n for n in self.known_nodes if not (n.startswith(parent + "/") or n == parent)])
+
+    def aug_set(self, path, val):
+        if path in self.known:
+            current = self.known[path]
+        elif path.rsplit("/", 1)[0] in self.known_nodes:
+            current = []  # no such node: always set
+        else:
+            try:
+                current = self.g.aug_get(path)
+            except RuntimeError:
+                current = []
+        if current == val:
+            print_debug("  %s is already %s" % (path, val))
+            return
+        result = self._apply("set", path, self.g.aug_set, val)
+        if path in self.known or path.rsplit("/", 1)[0] in self.known_nodes:
+            self.known[path] = val
+        return result
+
+    def aug_insert(self, path, label, before):
+        self._forget(path)
+        return self._apply("insert", path, self.g.aug_insert, label, before)
+
+    def aug_rm(self, path):
+        self._forget(path)
+        count = self._apply("rm", path, self.g.aug_rm)
+        if count == 0: self.ops.pop()
+        return count
+
+    def aug_clear(self, path):
+        self.known.pop(path, None)
+        return self._apply("clear", path, self.g.aug_clear)
+
+    def aug_save(self):
+        print_debug("==> aug_transaction.aug_save(): deferred to commit()")
+
+    def journal_file(self, path, content=None, new=False):
+        # called before path is written; content is its current content, if
+        # the caller has already read it (new: it is known not to exist).
+        # None is recorded for a new file.
+        if path in self.originals:
+            return
+        if content is None and not new and self.g.is_file(path):
+            content = self.g.read_file(path)
+        self.originals[path] = content
+
+    def journal_written(self, path, content):
+        # content is what path was written with (None: removed), so that
+        # write_journal() doesn't read it back
+        self.written[path] = content
+
+    def journal_aug_files(self):
+        # the files aug_save() is going to write are the loaded files the
+        # recorded operations are under
+        loaded = set([self.g.aug_get(p) for p in self.g.aug_match("/augeas/files//path")])
+        for (op, path, args) in self.ops:
+            parts = path.split("/")
+            for i in range(3, len(parts) + 1):
+                if "/".join(parts[:i]) in loaded:
+                    self.journal_file(re.sub("^/files", "", "/".join(parts[:i])))
+                    break
+
+    def mark_touched(self, path):
+        # files written outside of augeas, relabelled after commit()
+        if path not in self.touched:
+            self.touched.append(path)
+
+    @profile_phase("aug_commit")
+    def commit(self):
+        print_debug("==> aug_transaction.commit(): %d operation(s)" % len(self.ops))
+        if gflags['dry_run']:
+            print "=> plan: %d augeas change(s)" % len(self.ops)
+            for (op, path, args) in self.ops:
+                print "  %-6s %s %s" % (op, path, " ".join([str(arg) for arg in args]))
+            return
+        if self.ops and not self.failed:
+            self.journal_aug_files()
+            try:
+                self.g.aug_save()
+            except RuntimeError as msg:
+                for errpath in self.g.aug_match("/augeas/files//error"):
+                    path = re.sub("^/augeas/files", "", os.path.dirname(errpath))
+                    self.failed.append(("save", path, self.g.aug_get(errpath)))
+                if not self.failed:
+                    self.failed.append(("save", "/", str(msg)))
+        if self.failed:
+            raise aug_transaction_error(self.failed)
+        if self.ops:
+            for event in self.g.aug_match("/augeas/events/saved"):
+                path = re.sub("^/files", "", self.g.aug_get(event))
+                self.mark_touched(path)
+                # saved but not loaded: augeas created it
+                self.originals.setdefault(path, None)
+
+    def write_journal(self):
+        # one gzipped JSON file per run: for each file written, the sha1 of
+        # the new content and the delta back to the original (or "created")
+        if gflags['dry_run']:
+            return None
+        files = {}
+        for (path, orig) in sorted(self.originals.items()):
+            if path in self.written:
+                new = self.written[path]
+            else:
+                new = self.g.read_file(path) if self.g.is_file(path) else None
+            if new == orig:
+                continue
+            entry = files[path] = {'sha1': hashlib.sha1(new).hexdigest() if new is not None else None}
+            if orig is None:
+                entry['created'] = True
+            else:
+                entry['delta'] = journal_delta(new or "", orig)
+        if not files:
+            return None
+        buf = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(json.dumps({'version': 1, 'os': gflags['os'], 'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                            'files': files}))
+        f.close()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        n = 0
+        path = "%s/%s-%02d.json.gz" % (JOURNAL_DIR, stamp, n)
+        while self.g.exists(path):
+            n += 1
+            path = "%s/%s-%02d.json.gz" % (JOURNAL_DIR, stamp, n)
+        print "==> undo journal: %s (%d file(s))" % (path, len(files))
+        if not self.g.is_dir(JOURNAL_DIR):
+            self.g.mkdir_p(JOURNAL_DIR)
+            self.mark_touched(os.path.dirname(JOURNAL_DIR))
+        self.g.write(path, buf.getvalue())
+        # labelled with the files it undoes
+        self.mark_touched(path)
+        return path
 
 class ifcfg_base:
     def __init__(self, g, ifname):
@@ -75,21 +373,47 @@ class ifcfg_base:
             print "%15s: %s" % ("nameserver", self.newdns)
             print "%15s: %s" % ("domain", self.newdomain)
 
+def ifcfg_rhel_snapshot(g):
+    # the ifcfg files (those augeas loads) are fetched with one tar_out and
+    # parsed here, instead of an aug_get per key. the values are kept as
+    # augeas shows them, quotes included. returns {ifname: {key: value}}
+    print_debug("==> ifcfg_rhel_snapshot()")
+    index = {}
+    for (name, content) in guestfs_read_dir(g, "/etc/sysconfig/network-scripts", "ifcfg-*").items():
+        if [excl for excl in AUG_EXCL if fnmatch.fnmatch(name, excl)]: continue
+        index[name[len("ifcfg-"):]] = parse_shellvars(content, unquote=False)
+    return index
+
+def ifcfg_ubuntu_snapshot(g):
+    # the iface stanzas and their keys are listed with two aug_match calls,
+    # instead of rescanning every stanza for every interface. every key is
+    # fetched, so that aug_transaction knows the whole stanza.
+    # returns {ifname: {'augpath': ..., key: value}}
+    print_debug("==> ifcfg_ubuntu_snapshot()")
+    augpaths = g.aug_match("/files/etc/network/interfaces/iface")
+    stanzas = dict([(augpath, {'augpath': augpath}) for augpath in augpaths])
+    for keypath in g.aug_match("/files/etc/network/interfaces/iface/*"):
+        (augpath, key) = keypath.rsplit("/", 1)
+        if augpath in stanzas:
+            stanzas[augpath][key] = g.aug_get(keypath)
+    index = {}
+    for augpath in augpaths:
+        index[g.aug_get(augpath)] = stanzas[augpath]
+    return index
+
 class ifcfg_rhel(ifcfg_base):
-    def __init__(self, g, ifname):
+
+    def __init__(self, g, ifname, snapshot=None):
         print_debug("==> ifcfg_rhel.__init__(): %s" % ifname)
         ifcfg_base.__init__(self, g, ifname)
+        if snapshot is None: snapshot = ifcfg_rhel_snapshot(g)
+        entry = dict([(key, value.replace('"', '')) for (key, value) in snapshot.get(ifname, {}).items()])
         self.augpath = "/files/etc/sysconfig/network-scripts/ifcfg-" + self.ifname
-        if g.aug_match(self.augpath + "/BOOTPROTO"):
-            self.bootproto = g.aug_get(self.augpath + "/BOOTPROTO").replace('"', '')
-        if g.aug_match(self.augpath + "/HWADDR"):
-            self.mac = g.aug_get(self.augpath + "/HWADDR").replace('"', '').lower()
-        if g.aug_match(self.augpath + "/IPADDR"):
-            self.ipaddr = g.aug_get(self.augpath + "/IPADDR").replace('"', '')
-        if g.aug_match(self.augpath + "/NETMASK"):
-            self.netmask = g.aug_get(self.augpath + "/NETMASK").replace('"', '')
-        if g.aug_match(self.augpath + "/UUID"):
-            self.uuid = g.aug_get(self.augpath + "/UUID").replace('"', '')
+        self.bootproto = entry.get("BOOTPROTO")
+        self.mac = entry["HWADDR"].lower() if entry.get("HWADDR") else None
+        self.ipaddr = entry.get("IPADDR")
+        self.netmask = entry.get("NETMASK")
+        self.uuid = entry.get("UUID")
 
     def commit_update(self):
         print_debug("==> ifcfg_rhel.update()")
@@ -115,32 +439,19 @@ class ifcfg_rhel(ifcfg_base):
         g.aug_set(augpath + "/USERCTL", '"no"')
         g.aug_set(augpath + "/PEERDNS", '"no"')
         g.aug_set(augpath + "/IPV6INIT", '"no"')
-        g.aug_save()
-
-        print "  - renaming backup files (ifcfg-eth*.augpath => _ifcfg-eth*.augpath)"
-        backup_path = path + ".augsave"
-        new_backup_path = os.path.dirname(backup_path) + "/_" + os.path.basename(backup_path)
-        if g.exists(backup_path):
-            g.mv(backup_path, new_backup_path)
-
-        print "  - repairing selinux labels"
-        #g.sh("restorecon " + path)
-        g.sh("chcon -t net_conf_t " + path)
 
 class ifcfg_ubuntu(ifcfg_base):
-    def __init__(self, g, ifname):
+
+    def __init__(self, g, ifname, snapshot=None):
         print_debug("==> ifcfg_ubuntu.__init__(): %s" % ifname)
         ifcfg_base.__init__(self, g, ifname)
-        if_augpaths = g.aug_match("/files/etc/network/interfaces/iface")
-        #print "  if_augpaths:", if_augpaths
-        for if_augpath in if_augpaths:
-            ifname_aug = g.aug_get(if_augpath)
-            #print "  ifname=%s, iface=%s" % (ifname_aug, ifname)
-            if ifname_aug == ifname:
-                self.augpath = if_augpath
-                if g.aug_match(self.augpath + "/method"):  self.bootproto = g.aug_get(self.augpath + "/method")
-                if g.aug_match(self.augpath + "/address"): self.ipaddr = g.aug_get(self.augpath + "/address")
-                if g.aug_match(self.augpath + "/netmask"): self.netmask = g.aug_get(self.augpath + "/netmask")
+        if snapshot is None: snapshot = ifcfg_ubuntu_snapshot(g)
+        entry = snapshot.get(ifname)
+        if entry:
+            self.augpath = entry['augpath']
+            self.bootproto = entry.get("method")
+            self.ipaddr = entry.get("address")
+            self.netmask = entry.get("netmask")
 
     def commit_update(self):
         print_debug("==> ifcfg_ubuntu.commit_update()")
@@ -153,6 +464,7 @@ class ifcfg_ubuntu(ifcfg_base):
             g.aug_set("/files/etc/network/interfaces/iface[last()]", self.ifname)
             g.aug_set("/files/etc/network/interfaces/iface[last()]/family", "inet")
             self.augpath = g.aug_match("/files/etc/network/interfaces/iface[last()]")[0]
+            g.aug_known(self.augpath, {"family": "inet"})
             print "  - setting %s (not exists, created)" % re.sub("^/files", "", self.augpath)
         else:
             print "  - setting %s (exists)" % re.sub("^/files", "", self.augpath)
@@ -163,7 +475,6 @@ class ifcfg_ubuntu(ifcfg_base):
         if self.primary and self.newgateway: g.aug_set(augpath + "/gateway", self.newgateway)
         if self.primary and self.newdns:     g.aug_set(augpath + "/dns-nameservers", " ".join(self.newdns))
         if self.primary and self.newdomain:  g.aug_set(augpath + "/dns-search", " ".join(self.newdomain))
-        g.aug_save()
 
 def print_debug(str):
     if gflags['debug']:
@@ -186,11 +497,16 @@ def parse_interface_option(optstr):
     return ret
 
 def generate_new_uuid():
-    #return os.popen("uuidgen").read().strip()
-    return virtinst.util.uuidToString(virtinst.util.randomUUID())
+    # random (version 4) UUID, formatted as libvirt does
+    u = bytearray(os.urandom(16))
+    u[6] = u[6] & 0x0f | 0x40
+    u[8] = u[8] & 0x3f | 0x80
+    h = "".join(["%02x" % c for c in u])
+    return "-".join([h[0:8], h[8:12], h[12:16], h[16:20], h[20:32]])
 
 def generate_new_mac():
-    return virtinst.util.randomMAC(type="qemu")
+    # 52:54:00 is the OUI used by QEMU/KVM
+    return "52:54:00:%02x:%02x:%02x" % tuple(bytearray(os.urandom(3)))
 
 def generate_new_macs(defined_macs, new_ifaces):
     new_macs = []
@@ -203,58 +519,767 @@ def generate_new_macs(defined_macs, new_ifaces):
             new_macs.append(generate_new_mac())
     return new_macs
 
-def guestfs_open(imgpath):
-    g = guestfs.GuestFS()
+class network_layout:
+    # the guest network of --network-layout, a JSON file such as
+    #   {"interfaces": [
+    #     {"name": "eth0", "type": "ethernet", "mac": "52:54:00:00:00:01", "master": "bond0"},
+    #     {"name": "eth1", "type": "ethernet", "mac": "52:54:00:00:00:02", "master": "bond0"},
+    #     {"name": "bond0", "type": "bond", "options": "mode=active-backup miimon=100"},
+    #     {"name": "bond0.100", "type": "vlan", "bridge": "br100"},
+    #     {"name": "br100", "type": "bridge", "ipaddr": "10.7.9.101", "netmask": "255.255.0.0"}],
+    #    "primary": "br100", "gateway": "10.7.9.1"}
+    # ethernet interfaces are the domain's NICs with that MAC in the template
+    # XML, whatever their position. ipaddr is an address, "dhcp", "auto"
+    # (--ip-pool=NAME=CIDR) or absent for none (bond slaves, bridge ports).
+    types = ["ethernet", "bond", "vlan", "bridge"]
+    cache = {}
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            layout = json.load(open(path))
+        except ValueError as msg:
+            raise RuntimeError("%s: %s" % (path, msg))
+        self.primary = str(layout['primary']) if layout.get('primary') else None
+        self.gateway = str(layout['gateway']) if layout.get('gateway') else None
+        self.interfaces = []
+        self.by_name = {}
+        for entry in layout.get('interfaces', []):
+            iface = dict([(str(k), str(v) if isinstance(v, basestring) else v) for (k, v) in entry.items()])
+            name = iface.get('name')
+            if not name or name in self.by_name:
+                raise RuntimeError("%s: interface without a name, or defined twice: %s" % (path, name))
+            if iface.setdefault('type', "ethernet") not in self.types:
+                raise RuntimeError("%s: %s: unknown type %s" % (path, name, iface['type']))
+            if iface['type'] == "ethernet":
+                if not iface.get('mac'):
+                    raise RuntimeError("%s: %s: needs the MAC of its NIC in the template XML" % (path, name))
+                iface['mac'] = iface['mac'].lower()
+            if iface['type'] == "bond":
+                iface.setdefault('options', "mode=active-backup miimon=100")
+            if iface['type'] == "vlan":
+                (device, sep, vlan_id) = name.rpartition(".")
+                iface.setdefault('device', device)
+                iface['id'] = str(iface.get('id', vlan_id))
+            self.interfaces.append(iface)
+            self.by_name[name] = iface
+        for iface in self.interfaces:
+            for (key, type) in (('master', "bond"), ('bridge', "bridge"), ('device', None)):
+                if key not in iface: continue
+                other = self.by_name.get(iface[key])
+                if not other or (type and other['type'] != type):
+                    raise RuntimeError("%s: %s: %s %s is not %s of the layout" % (path, iface['name'], key, iface[key],
+                                                                               "a " + type if type else "an interface"))
+            if iface['type'] == "vlan" and not iface['id'].isdigit():
+                raise RuntimeError("%s: %s: VLAN id missing" % (path, iface['name']))
+        if self.primary and self.primary not in self.by_name:
+            raise RuntimeError("%s: primary %s is not an interface of the layout" % (path, self.primary))
+
+    @classmethod
+    def load(cls, path):
+        # as domain_template.load(): parsed once for all clones of a batch
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size, st.st_ino)
+        cached = cls.cache.get(path)
+        if cached is None or cached[0] != key:
+            cached = cls.cache[path] = (key, cls(path))
+        return cached[1]
+
+    def ordered(self):
+        # lower layers first: NICs, bonds, VLANs on them, bridges
+        return sorted(self.interfaces, key=lambda iface: self.types.index(iface['type']))
+
+    def members(self, key, name):
+        # slaves of a bond (key "master") or ports of a bridge (key "bridge")
+        return [iface['name'] for iface in self.interfaces if iface.get(key) == name]
+
+    def nics(self, defined_macs, new_macs):
+        # [(iface, MAC in the template, new MAC)] of the ethernet interfaces
+        macs = [mac.lower() for mac in defined_macs]
+        nics = []
+        for iface in self.interfaces:
+            if iface['type'] != "ethernet": continue
+            if iface['mac'] not in macs:
+                raise RuntimeError("%s: %s: the domain has no NIC with MAC %s" % (self.path, iface['name'], iface['mac']))
+            i = macs.index(iface['mac'])
+            nics.append((iface, macs[i], new_macs[i].lower()))
+        return nics
+
+    def address(self, iface, addresses):
+        # (ipaddr, netmask), with "auto" decided by allocate()
+        (ipaddr, netmask) = addresses.get(iface['name']) or (iface.get('ipaddr'), iface.get('netmask'))
+        if "auto" in (ipaddr, netmask):
+            raise RuntimeError("%s: %s: \"auto\" needs --state and --ip-pool=%s=CIDR" % (self.path, iface['name'],
+                                                                                       iface['name']))
+        return (ipaddr, netmask)
+
+def job_network_layout(job):
+    if job.get('interface'):
+        raise RuntimeError("--network-layout and --interface can't be used together")
+    return network_layout.load(job['network_layout'])
+
+def ip_to_int(ipaddr):
+    return struct.unpack("!I", socket.inet_aton(ipaddr))[0]
+
+def int_to_ip(n):
+    return socket.inet_ntoa(struct.pack("!I", n))
+
+def parse_ip_pool_option(optstr):
+    # "eth0=10.7.9.0/24,eth1=192.168.0.0/24"
+    pools = {}
+    for pool in optstr.split(","):
+        (ifname, cidr) = pool.split("=")
+        (network, prefix) = cidr.split("/")
+        prefix = int(prefix)
+        if not 0 < prefix < 31:
+            raise RuntimeError("--ip-pool: %s: prefix must be between 1 and 30" % cidr)
+        mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        pools[ifname] = {'cidr': "%s/%d" % (int_to_ip(ip_to_int(network) & mask), prefix),
+                         'network': ip_to_int(network) & mask, 'size': 1 << (32 - prefix),
+                         'netmask': int_to_ip(mask)}
+    return pools
+
+def read_domain_xml_ids(xmlpath):
+    from lxml import etree
+    xml = etree.parse(xmlpath, parser=etree.XMLParser())
+    uuid = xml.xpath("/domain/uuid/text()")
+    return {'uuid': uuid[0].strip() if uuid else None,
+            'macs': [mac.lower() for mac in xml.xpath("/domain/devices/interface/mac/@address")]}
+
+class allocator:
+    # index of the MACs, UUIDs and pool IPs in use, so that generated values
+    # never collide with an existing domain or with an earlier clone.
+    # with a state file the index persists between runs: the domain XMLs in
+    # xml_dir are parsed only when they are new or changed (by mtime), and
+    # allocations are kept per owner (the clone's XML path) so that adjusting
+    # a clone again reuses its MACs, UUID and pool IPs. the state file is
+    # locked while open.
+    # values are reference counted, so releasing an owner is O(1).
+    def __init__(self, path=None, xml_dir=None):
+        self.path = path
+        self.lockfile = None
+        self.state = {'version': 1, 'files': {}, 'owners': {}, 'hints': {}}
+        if path:
+            self.lockfile = open(path + ".lock", 'a')
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                self.state = json.load(open(path))
+        if xml_dir:
+            self.scan(os.path.abspath(xml_dir))
+        self.macs = {}
+        self.uuids = {}
+        self.ips = {}
+        self.files_by_uuid = {}
+        for (xmlpath, entry) in self.state['files'].items():
+            self.index(entry, 1)
+            if entry['uuid']: self.files_by_uuid.setdefault(entry['uuid'], []).append(xmlpath)
+        for entry in self.state['owners'].values():
+            self.index(entry, 1)
+
+    def scan(self, xml_dir):
+        files = self.state['files']
+        present = set()
+        for name in os.listdir(xml_dir) if os.path.isdir(xml_dir) else []:
+            if not name.endswith(".xml"): continue
+            xmlpath = os.path.join(xml_dir, name)
+            present.add(xmlpath)
+            mtime = os.stat(xmlpath).st_mtime
+            if xmlpath in files and files[xmlpath]['mtime'] == mtime: continue
+            try:
+                files[xmlpath] = read_domain_xml_ids(xmlpath)
+            except SyntaxError as msg:  # lxml's XMLSyntaxError
+                print "** %s: %s, skipping" % (xmlpath, msg)
+                files[xmlpath] = {'uuid': None, 'macs': []}
+            files[xmlpath]['mtime'] = mtime
+        for xmlpath in files.keys():
+            if os.path.dirname(xmlpath) == xml_dir and xmlpath not in present:
+                del files[xmlpath]
+
+    def count(self, table, key, delta):
+        n = table.get(key, 0) + delta
+        if n > 0: table[key] = n
+        else: table.pop(key, None)
+
+    def index(self, entry, delta):
+        for mac in entry['macs']:
+            self.count(self.macs, mac, delta)
+        if entry['uuid']:
+            self.count(self.uuids, entry['uuid'], delta)
+        for (cidr, ipaddr) in entry.get('ips', {}).values():
+            self.count(self.ips.setdefault(cidr, {}), ipaddr, delta)
+
+    def release(self, owner):
+        entry = self.state['owners'].pop(owner, None)
+        if entry:
+            self.index(entry, -1)
+        return entry
+
+    def new_mac(self):
+        while True:
+            mac = generate_new_mac()
+            if mac not in self.macs:
+                self.macs[mac] = 1
+                return mac
+
+    def new_uuid(self):
+        while True:
+            uuid = generate_new_uuid()
+            if uuid not in self.uuids:
+                self.uuids[uuid] = 1
+                return uuid
+
+    def claim_mac(self, mac, owner):
+        if mac in self.macs:
+            raise RuntimeError("%s: MAC address %s is already in use" % (owner, mac))
+        self.macs[mac] = 1
+
+    def claim_ip(self, pool, ipaddr, owner):
+        used = self.ips.setdefault(pool['cidr'], {})
+        if ipaddr in used:
+            raise RuntimeError("%s: %s is already in use" % (owner, ipaddr))
+        used[ipaddr] = 1
+
+    def new_ip(self, pool, reserved):
+        # first fit from where the last allocation in this pool stopped
+        used = self.ips.setdefault(pool['cidr'], {})
+        hosts = pool['size'] - 2
+        hint = self.state['hints'].get(pool['cidr'], 0)
+        for i in range(hosts):
+            n = (hint + i) % hosts
+            ipaddr = int_to_ip(pool['network'] + 1 + n)
+            if ipaddr in used or ipaddr in reserved: continue
+            used[ipaddr] = 1
+            self.state['hints'][pool['cidr']] = n + 1
+            return ipaddr
+        raise RuntimeError("--ip-pool: no free address left in %s" % pool['cidr'])
+
+    def assign_ip(self, owner, ifname, ipaddr, netmask, pools, previous, reserved, ips):
+        # "auto" takes the address ifname had before if it is still free, or
+        # the next free one of its pool; an address given inside a pool is claimed
+        pool = pools.get(ifname)
+        if ipaddr == "auto" or netmask == "auto":
+            if not pool:
+                raise RuntimeError("%s: %s needs --ip-pool=%s=CIDR for \"auto\"" % (owner, ifname, ifname))
+            if netmask == "auto": netmask = pool['netmask']
+        if ipaddr == "auto":
+            kept = previous['ips'].get(ifname)
+            if kept and kept[0] == pool['cidr'] and kept[1] not in self.ips.get(pool['cidr'], {}):
+                ipaddr = str(kept[1])
+                self.claim_ip(pool, ipaddr, owner)
+            else:
+                ipaddr = self.new_ip(pool, reserved)
+        elif pool and ipaddr not in ("dhcp", None):
+            self.claim_ip(pool, ipaddr, owner)
+        if pool and ipaddr not in ("dhcp", None):
+            ips[ifname] = (pool['cidr'], ipaddr)
+        return (ipaddr, netmask)
+
+    def assign(self, job, pools):
+        # replaces "auto" in job['interface'] (or the addresses of the
+        # --network-layout, in job['addresses']) by concrete values, and sets
+        # the MACs of all the NICs of the domain and its UUID in the job
+        owner = os.path.abspath(job['xmlpath'])
+        template = domain_template.load(job_xml_template(job))
+        previous = self.release(owner) or {'uuid': None, 'macs': [], 'ips': {}}
+        # the domain doesn't collide with its own definition: the one adjusted
+        # in place, or the one defined from the owner's last run
+        for uuid in set([template.uuid if not job.get('base_image') else None, previous['uuid']]):
+            for xmlpath in self.files_by_uuid.pop(uuid, []) if uuid else []:
+                self.index(self.state['files'][xmlpath], -1)
+        new_ifaces = parse_interface_option(job['interface']) if job.get('interface') else {}
+        reserved = set([job['gateway']]) if job.get('gateway') else set()
+        interfaces = []
+        macs = []
+        ips = {}
+        for i in range(len(template.macs)):
+            ifname = "eth" + str(i)
+            iface = new_ifaces.pop(ifname, None)
+            if iface and iface['mac'] != "auto":
+                self.claim_mac(iface['mac'], owner)
+                macs.append(iface['mac'])
+            elif i < len(previous['macs']) and str(previous['macs'][i]) not in self.macs:
+                # as with addresses, a NIC keeps the MAC of the owner's last run
+                macs.append(str(previous['macs'][i]))
+                self.macs[macs[i]] = 1
+            else:
+                macs.append(self.new_mac())
+            if not iface:
+                continue
+            (ipaddr, netmask) = self.assign_ip(owner, ifname, iface['ipaddr'], iface['netmask'],
+                                               pools, previous, reserved, ips)
+            interfaces.append("/".join([ifname, macs[i], ipaddr, netmask]))
+        if new_ifaces:
+            raise RuntimeError("%s: the domain has no %s" % (owner, ", ".join(sorted(new_ifaces))))
+        if job.get('interface'):
+            job['interface'] = ",".join(interfaces)
+        if job.get('network_layout'):
+            layout = job_network_layout(job)
+            if layout.gateway: reserved.add(layout.gateway)
+            job['addresses'] = {}
+            for iface in layout.interfaces:
+                if "auto" in (iface.get('ipaddr'), iface.get('netmask')):
+                    job['addresses'][iface['name']] = self.assign_ip(owner, iface['name'], iface.get('ipaddr'),
+                                                                     iface.get('netmask'), pools, previous,
+                                                                     reserved, ips)
+        job['macs'] = macs
+        if previous['uuid'] and str(previous['uuid']) not in self.uuids:
+            job['uuid'] = str(previous['uuid'])
+            self.uuids[job['uuid']] = 1
+        else:
+            job['uuid'] = self.new_uuid()
+        self.state['owners'][owner] = {'uuid': job['uuid'], 'macs': macs, 'ips': ips}
+
+    def close(self, save=True):
+        if self.path and save:
+            write_file_atomic(self.path, json.dumps(self.state, indent=1, sort_keys=True) + "\n")
+        if self.lockfile:
+            self.lockfile.close()
+            self.lockfile = None
+
+def allocate(options, jobs):
+    # MACs, UUIDs and pool IPs of all the jobs are decided up front, in this
+    # process, so worker processes and the daemon never allocate themselves
+    if options.ip_pool and not options.state:
+        raise RuntimeError("--ip-pool needs --state to remember the addresses in use")
+    pools = parse_ip_pool_option(options.ip_pool) if options.ip_pool else {}
+    alloc = allocator(options.state, options.xml_dir if options.state else None)
+    try:
+        for job in jobs:
+            if job.get('interface') or job.get('base_image') or job.get('network_layout'):
+                alloc.assign(job, pools)
+    except:
+        alloc.close(save=False)
+        raise
+    alloc.close(save=not options.dry_run)
+
+class local_guestfs:
+    # the subset of the guestfs API the adjusters use, working directly on
+    # root trees on the host (extracted or loop-mounted templates) instead of
+    # an appliance. "drives" are directories, each one is its own root.
+    # guest paths are resolved inside the root, as the guest would see them:
+    # symlinks are followed by hand (absolute ones from the root), and a path
+    # leading out of the root is refused, so that a link such as
+    # /etc/resolv.conf -> /run/... never reaches the host's files.
+    def __init__(self):
+        self.roots = []
+        self.root = None
+        self.aug = None
+
+    def _path(self, path, follow=True):
+        # host path of path; with follow=False a symlink in the last
+        # component is not followed (rm_f, mv, exists)
+        if self.root is None:
+            raise RuntimeError("no root is mounted")
+        parts = [part for part in path.split("/") if part not in ("", ".")]
+        resolved = []
+        links = 0
+        while parts:
+            part = parts.pop(0)
+            if part == "..":
+                if not resolved:
+                    raise RuntimeError("%s: leads out of %s" % (path, self.root))
+                resolved.pop()
+                continue
+            host = os.path.join(self.root, *(resolved + [part]))
+            if os.path.islink(host) and (follow or parts):
+                links += 1
+                if links > 40:
+                    raise RuntimeError("%s: too many levels of symbolic links" % path)
+                target = os.readlink(host)
+                if target.startswith("/"): resolved = []
+                parts = [p for p in target.split("/") if p not in ("", ".")] + parts
+                continue
+            resolved.append(part)
+        return os.path.join(self.root, *resolved)
+
+    def _check_aug_file(self, path):
+        # augeas opens the files itself, following symlinks on the host
+        real = os.path.realpath(path)
+        if real != os.path.realpath(self.root) and not real.startswith(os.path.realpath(self.root) + "/"):
+            raise RuntimeError("%s: leads out of %s (%s)" % (path[len(self.root):], self.root, real))
+
+    def _read(self, path, name):
+        try:
+            return open(self._path(path), 'r').read()
+        except IOError as e:
+            raise RuntimeError("%s: %s: %s" % (name, path, e.strerror))
+
+    def set_autosync(self, autosync): pass
+    def set_selinux(self, selinux): pass
+    def launch(self): pass
+    def sync(self): pass
+    def close(self): pass
+    def is_lv(self, device): return False
+    def part_to_dev(self, part): return part
+    def list_devices(self): return self.roots
+
+    def add_drive_opts(self, filename, readonly=0, **d):
+        if not os.path.isdir(filename):
+            raise RuntimeError("%s: not a directory (local backend needs a root tree)" % filename)
+        self.roots.append(os.path.abspath(filename))
+
+    def inspect_os(self):
+        return list(self.roots)
+
+    def inspect_get_mountpoints(self, root):
+        return [("/", root)]
+
+    def mount(self, device, mountpoint):
+        self.root = device
+
+    def umount_all(self):
+        self.root = None
+
+    def _release(self, root):
+        saved = self.root
+        self.root = root
+        try:
+            if self.is_file("/etc/redhat-release"):
+                m = re.search(r"release (\d+)\.?(\d*)", self.read_file("/etc/redhat-release"))
+                return ("rhel", int(m.group(1)), int(m.group(2) or 0), self.read_lines("/etc/redhat-release")[0])
+            if self.is_file("/etc/lsb-release"):
+                d = dict([line.split("=", 1) for line in self.read_lines("/etc/lsb-release") if "=" in line])
+                (major, minor) = (d.get("DISTRIB_RELEASE", "0") + ".0").split(".")[:2]
+                return (d.get("DISTRIB_ID", "unknown").lower(), int(major), int(minor),
+                        d.get("DISTRIB_DESCRIPTION", "").strip('"'))
+            return ("unknown", 0, 0, "unknown")
+        finally:
+            self.root = saved
+
+    def inspect_get_type(self, root): return "linux"
+    def inspect_get_distro(self, root): return self._release(root)[0]
+    def inspect_get_major_version(self, root): return self._release(root)[1]
+    def inspect_get_minor_version(self, root): return self._release(root)[2]
+    def inspect_get_product_name(self, root): return self._release(root)[3]
+
+    def inspect_get_hostname(self, root):
+        saved = self.root
+        self.root = root
+        try:
+            if self.is_file("/etc/hostname"):
+                return self.read_lines("/etc/hostname")[0]
+            for line in self.read_lines("/etc/sysconfig/network"):
+                if line.startswith("HOSTNAME="): return line.split("=", 1)[1].strip('"')
+        except (RuntimeError, IndexError):
+            pass
+        finally:
+            self.root = saved
+        return "unknown"
+
+    def exists(self, path): return os.path.lexists(self._path(path, follow=False))
+    def is_file(self, path): return os.path.isfile(self._path(path))
+    def is_dir(self, path): return os.path.isdir(self._path(path))
+    def read_file(self, path): return self._read(path, "read_file")
+    def read_lines(self, path): return self._read(path, "read_lines").splitlines()
+    def write(self, path, content): open(self._path(path), 'w').write(content)
+    def touch(self, path): open(self._path(path), 'a').close()
+    def mv(self, src, dest): os.rename(self._path(src, follow=False), self._path(dest, follow=False))
+    def cp_a(self, src, dest): shutil.copy2(self._path(src), self._path(dest))
+    def checksum(self, csumtype, path): return hashlib.new(csumtype, self.read_file(path)).hexdigest()
+    def ls(self, path): return sorted(os.listdir(self._path(path)))
+
+    def rm_f(self, path):
+        if os.path.lexists(self._path(path, follow=False)): os.unlink(self._path(path, follow=False))
+
+    def mkdir_p(self, path):
+        if not os.path.isdir(self._path(path)): os.makedirs(self._path(path))
+
+    def egrep(self, regex, path):
+        return [line for line in self.read_lines(path) if re.search(regex, line)]
+
+    # for guestfs_print_misc(): the root tree is the only "filesystem"
+    def list_partitions(self): return []
+    def list_filesystems(self): return {}
+    def lvs(self): return []
+    def mounts(self): return [self.root] if self.root else []
+    def mountpoints(self): return {self.root: "/"} if self.root else {}
+
+    def tar_out(self, directory, tarfile):
+        import tarfile as tarmod
+        tar = tarmod.open(tarfile, 'w')
+        tar.add(self._path(directory), arcname=".")
+        tar.close()
+
+    def tar_in(self, tarfile, directory):
+        # member by member through write(), not extractall(), so that the
+        # names and existing symlinks are resolved inside the root
+        import tarfile as tarmod
+        tar = tarmod.open(tarfile)
+        for member in tar.getmembers():
+            if member.isfile():
+                path = directory.rstrip("/") + "/" + member.name
+                self.write(path, tar.extractfile(member).read())
+                os.chmod(self._path(path), member.mode)
+        tar.close()
+
+    def sh(self, command):
+        p = subprocess.Popen(["chroot", self.root, "/bin/sh", "-c", command],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = p.communicate()
+        if p.returncode != 0:
+            raise RuntimeError("%s: %s" % (command, err.strip()))
+        return out
+
+    def aug_init(self, root, flags):
+        try:
+            import augeas
+        except ImportError:
+            raise RuntimeError("the local backend needs python-augeas")
+        # a full load would read every file of the tree without the checks of
+        # aug_load(), following symlinks out of it
+        if not flags & AUG_NO_LOAD:
+            raise RuntimeError("the local backend loads only the files of known operations, "
+                               "%s has none listed" % gflags['os'])
+        self.aug = augeas.Augeas(root=self._path(root), flags=flags)
+
+    def _aug(self, func, *args):
+        try:
+            return func(*args)
+        except (ValueError, IOError) as e:
+            raise RuntimeError("%s%s: %s" % (func.__name__, args, e))
+
+    def aug_close(self):
+        if self.aug: self.aug.close()
+        self.aug = None
+
+    def aug_load(self):
+        import glob
+        for incl in self.aug.match("/augeas/load/*/incl"):
+            for path in glob.glob(os.path.join(self.root, self.aug.get(incl).lstrip("/"))):
+                self._check_aug_file(path)
+        return self._aug(self.aug.load)
+
+    def aug_save(self):
+        for path in self.aug.match("/augeas/files//path"):
+            self._check_aug_file(os.path.join(self.root, re.sub("^/files/", "", self.aug.get(path))))
+        return self._aug(self.aug.save)
+    def aug_match(self, path): return self._aug(self.aug.match, path)
+    def aug_get(self, path): return self._aug(self.aug.get, path)
+    def aug_set(self, path, val): return self._aug(self.aug.set, path, val)
+    def aug_clear(self, path): return self._aug(self.aug.set, path, None)
+    def aug_rm(self, path): return self._aug(self.aug.remove, path)
+    def aug_insert(self, path, label, before): return self._aug(self.aug.insert, path, label, bool(before))
+
+def guestfs_handle():
+    if gflags['backend'] == "local":
+        return profile_guestfs(local_guestfs())
+    # imported here so that the local backend, seed mode and XML-only
+    # commands start without libguestfs
+    import guestfs
+    return profile_guestfs(guestfs.GuestFS())
+
+@profile_phase("guestfs_launch")
+def guestfs_launch(imgpaths, readonly=False):
+    g = guestfs_handle()
     g.set_autosync(1)
-    g.add_drive_opts(imgpath, readonly=0)
-    print_debug("==> guestfs launch(): %s" % imgpath)
+    for imgpath in imgpaths:
+        g.add_drive_opts(imgpath, readonly=1 if readonly or gflags['dry_run'] else 0)
+    print_debug("==> guestfs launch(): %s" % imgpaths)
     g.set_selinux(1)
     g.launch()
+    return g
+
+def guestfs_root_drive(g, root, devices=None):
+    # returns the index (= order of add_drive_opts) of the drive holding root
+    devices = devices or g.list_devices()
+    pvs = [root]
+    if g.is_lv(root):
+        vg = root.split("/")[2]
+        vg_pvuuids = g.vgpvuuids(vg)
+        pvs = [pv for pv in g.pvs() if g.pvuuid(pv) in vg_pvuuids]
+    for pv in pvs:
+        dev = pv if pv in devices else g.part_to_dev(pv)
+        if dev in devices:
+            return devices.index(dev)
+    return None
+
+def guestfs_drive_partitions(g, devices):
+    # {(drive, partition number): partition} of every drive in the appliance
+    partitions = {}
+    for part in g.list_partitions():
+        dev = g.part_to_dev(part)
+        if dev in devices:
+            partitions[(devices.index(dev), g.part_to_partnum(part))] = part
+    return partitions
+
+def guestfs_drive_mountpoints(g, root, drive, devices, partitions):
+    # inspect_get_mountpoints() of root, with every filesystem on root's own
+    # drive. clones of one golden image share filesystem UUIDs and labels,
+    # and libguestfs resolves UUID=/LABEL= to the first matching device,
+    # which can be on the drive of another clone attached to the same
+    # appliance: that partition is replaced by the one with the same number
+    # on drive. None: a logical volume of another drive (clones sharing a VG
+    # name can't be activated together), which can't be mapped
+    mount_points = []
+    for (mount_point, dev) in g.inspect_get_mountpoints(root):
+        if guestfs_root_drive(g, dev, devices) != drive:
+            if dev in devices:
+                mapped = devices[drive]
+            elif g.is_lv(dev):
+                mapped = None
+            else:
+                mapped = partitions.get((drive, g.part_to_partnum(dev)))
+            print_debug("  %s: %s is on another drive, using %s" % (mount_point, dev, mapped))
+            if mapped is None:
+                return None
+            dev = mapped
+        mount_points.append((mount_point, dev))
+    return mount_points
+
+def guestfs_aug_init(g, os, opnames):
+    files = aug_files_for_ops(os, opnames)
+    if files is None:
+        g.aug_init("/", 0)
+        return
+    # load only the lenses and files the selected operations work on,
+    # instead of every lens against the whole /etc
+    print_debug("==> guestfs_aug_init(): %s" % files)
+    g.aug_init("/", AUG_NO_LOAD | AUG_NO_MODL_AUTOLOAD)
+    lenses = []
+    for lens, path in files:
+        xfm = "/augeas/load/" + lens
+        if lens not in lenses:
+            lenses.append(lens)
+            g.aug_set(xfm + "/lens", lens + ".lns")
+            # backups and package leftovers can only match a glob; a lens
+            # with exact paths only needs no excludes
+            if [p for (l, p) in files if l == lens and re.search(r"[*?\[]", p)]:
+                for excl in AUG_EXCL:
+                    g.aug_set(xfm + "/excl[last()+1]", excl)
+        g.aug_set(xfm + "/incl[last()+1]", path)
+    if files:
+        g.aug_load()
+
+@profile_phase("guestfs_mount_root")
+def guestfs_mount_root(g, root, opnames=None, use_base=True, mount_points=None):
+    print "==> guestfs mount (root: %s)" % root
+    print "  Product Name:", g.inspect_get_product_name(root)
+    #print "  Product Variant:", g.inspect_get_product_variant(root)
+    major = g.inspect_get_major_version(root)
+    #print "  Major Version:", major
+    minor = g.inspect_get_minor_version(root)
+    #print "  Minor Version:", minor
+    type = g.inspect_get_type(root)
+    #print "  Type:", type
+    distro = g.inspect_get_distro(root)
+    #print "  Distro:", distro
+    print "  Hostname:", g.inspect_get_hostname(root)
+    #print "  Package Format:", g.inspect_get_package_format(root)
+    #print "  Package Management:", g.inspect_get_package_management(root)
+    if type != "linux":
+        print "** %s is not supported." % type
+        sys.exit(1)
+    gflags['os'] = "%s-%s-%s-%s" % (type, distro, major, minor)
+    print "  OS:", gflags['os']
+    # mount_points: those of root mapped to its drive (batch mode)
+    mount_points = list(mount_points or g.inspect_get_mountpoints(root))
+    mount_points.sort(compare_pathlen)
+    print "  Mount Points:", mount_points
+    paths = mount_paths_for_ops(gflags['os'], opnames)
+    for mount_point, dev in mount_points:
+        if paths is not None and not [path for path in paths if path_on_mount_point(path, mount_point)]:
+            print_debug("    %s => %s (not needed, not mounted)" % (mount_point, dev))
+            continue
+        print_debug("    %s => %s" % (mount_point, dev))
+        try:
+            g.mount(dev, mount_point)
+        except RuntimeError as msg:
+            # writing under the mount point of a filesystem that isn't
+            # mounted would change the wrong one
+            if paths is not None:
+                raise RuntimeError("mounting %s on %s failed: %s" % (dev, mount_point, msg))
+            print_debug("%s (ignored)" % msg)
+
+    gflags['base_ops'] = guestfs_read_base(g, gflags['os']) if use_base else []
+    if opnames is not None:
+        opnames = [opname for opname in opnames if opname not in gflags['base_ops']]
+    guestfs_aug_init(g, gflags['os'], opnames)
+
+BASE_FINGERPRINT = "/etc/kvm_image_adjuster/base.json"
+
+def guestfs_checksum(g, path):
+    return g.checksum("sha1", path) if g.is_file(path) else None
+
+def guestfs_read_base(g, os):
+    # the clone-invariant operations prepare-base already applied to the
+    # image this one was cloned from. an operation only counts as done while
+    # the files it wrote still have the checksums recorded at that time.
+    if not g.is_file(BASE_FINGERPRINT):
+        return []
+    try:
+        base = json.loads(g.read_file(BASE_FINGERPRINT))
+    except ValueError as msg:
+        print "  ** %s: %s, ignored" % (BASE_FINGERPRINT, msg)
+        return []
+    if base.get('os') != os:
+        return []
+    done = []
+    for (opname, files) in sorted(base.get('ops', {}).items()):
+        if all([guestfs_checksum(g, path) == csum for (path, csum) in files.items()]):
+            done.append(opname)
+        else:
+            print_debug("  %s changed since prepare-base" % opname)
+    print "  Base: %s" % (", ".join(done) if done else "not prepared")
+    return done
+
+def guestfs_write_base(g, os, opnames):
+    files = base_files.get(re.sub('-[^-]+$', '', os), {})
+    base = {'os': os, 'prepared': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'ops': dict([(opname, dict([(path, guestfs_checksum(g, path)) for path in files.get(opname, [])]))
+                         for opname in opnames])}
+    print "==> base fingerprint (%s): %s" % (BASE_FINGERPRINT, ", ".join(opnames))
+    if gflags['dry_run']:
+        print "  (dry-run) %s would be written" % BASE_FINGERPRINT
+        return
+    g.mkdir_p(BASE_FINGERPRINT.rsplit("/", 1)[0])
+    g.journal_file(BASE_FINGERPRINT)
+    g.write(BASE_FINGERPRINT, json.dumps(base, indent=1, sort_keys=True) + "\n")
+    g.mark_touched(BASE_FINGERPRINT)
+
+@profile_phase("guestfs_relabel")
+def guestfs_relabel(g, paths):
+    # one setfiles run over every file the adjuster wrote, driven by the
+    # guest's file_contexts. the policy is not loaded in the appliance, so if
+    # setfiles can't set the labels the guest relabels itself on next boot.
+    # runs after write_journal(), so /.autorelabel is left by rollback (the
+    # guest only relabels itself once more)
+    print_debug("==> guestfs_relabel(): %s" % paths)
+    if not paths or gflags['dry_run'] or not g.is_file("/etc/selinux/config"):
+        return
+    policy = "targeted"
+    for line in g.read_lines("/etc/selinux/config"):
+        m = re.match(r"\s*SELINUXTYPE\s*=\s*(\S+)", line)
+        if m: policy = m.group(1)
+    file_contexts = "/etc/selinux/%s/contexts/files/file_contexts" % policy
+    if not g.is_file(file_contexts):
+        print_debug("  %s not found, skipping relabel" % file_contexts)
+        return
+    print "==> relabelling %d file(s) (%s)" % (len(paths), file_contexts)
+    try:
+        g.sh("setfiles -F %s %s" % (file_contexts, " ".join(paths)))
+    except RuntimeError as msg:
+        print "  setfiles failed, marking for relabel on next boot (/.autorelabel)"
+        print_debug("  %s" % msg)
+        g.touch("/.autorelabel")
+
+def guestfs_open(imgpath, opnames=None, use_base=True):
+    g = guestfs_launch([imgpath])
     print_debug("==> guestfs inspect_os()")
     roots = g.inspect_os()
     for root in roots:
-        print "==> guestfs mount (root: %s)" % root
-        print "  Product Name:", g.inspect_get_product_name(root)
-        #print "  Product Variant:", g.inspect_get_product_variant(root)
-        major = g.inspect_get_major_version(root)
-        #print "  Major Version:", major
-        minor = g.inspect_get_minor_version(root)
-        #print "  Minor Version:", minor
-        type = g.inspect_get_type(root)
-        #print "  Type:", type
-        distro = g.inspect_get_distro(root)
-        #print "  Distro:", distro
-        print "  Hostname:", g.inspect_get_hostname(root)
-        #print "  Package Format:", g.inspect_get_package_format(root)
-        #print "  Package Management:", g.inspect_get_package_management(root)
-        mount_points = g.inspect_get_mountpoints(root)
-        mount_points.sort(compare_pathlen)
-        print "  Mount Points:", mount_points
-        for mount_point, dev in mount_points:
-            print_debug("    %s => %s" % (mount_point, dev))
-            try:
-                g.mount(dev, mount_point)
-            except RuntimeError as msg:
-                print_debug("%s (ignored)" % msg)
-        g.aug_init("/", AUG_SAVE_BACKUP)
-
-        if type != "linux":
-            print "** %s is not supported." % type
-            sys.exit(1)
-        gflags['os'] = "%s-%s-%s-%s" % (type, distro, major, minor)
-        print "  OS:", gflags['os']
-
-        if g.exists("/sbin/load_policy"):
-            g.sh("/sbin/load_policy")
-            print "==> SElinux policy loaded"
+        guestfs_mount_root(g, root, opnames, use_base)
     return g
 
-def guestfs_close(g):
-    g.aug_save()
+@profile_phase("guestfs_unmount")
+def guestfs_unmount(g):
     g.aug_close()
     g.sync()
     g.umount_all()
 
+def guestfs_close(g):
+    guestfs_unmount(g)
+
 def guestfs_print_misc(g):
     print "==> guestfs_print_misc()"
     print " ", g.list_partitions()
@@ -266,35 +1291,414 @@ def guestfs_print_misc(g):
 
 def guestfs_write_file(g, path, content):
     print_debug("===> guestfs_write_file()")
-    if g.exists(path):
-        orig_path = path + ".adjuster_orig"
-        print_debug("  file (%s) exists, creating backup as %s" % (path, orig_path))
-        g.cp_a(path, orig_path)
+    orig = g.read_file(path) if g.is_file(path) else None
+    if orig == content:
+        print_debug("  %s not changed" % path)
+        return
+    if gflags['dry_run']:
+        print "  (dry-run) %s would be written" % path
+        return
+    g.journal_file(path, orig)
     g.write(path, content)
+    g.mark_touched(path)
+
+def guestfs_rewrite_file(g, path, rewrite):
+    # reads path once, lets rewrite() change the whole content in python and
+    # writes it back with one g.write(), instead of running sed via g.sh()
+    print_debug("===> guestfs_rewrite_file(): %s" % path)
+    content = g.read_file(path)
+    new_content = rewrite(content)
+    if new_content == content:
+        print_debug("  %s not changed" % path)
+        return False
+    if gflags['dry_run']:
+        print "  (dry-run) %s would be rewritten" % path
+        return True
+    g.journal_file(path, content)
+    g.write(path, new_content)
+    g.mark_touched(path)
+    return True
+
+def guestfs_read_dir(g, directory, pattern="*"):
+    # {name: content} of the files of directory matching pattern, fetched
+    # with one tar_out instead of a read_file() per file
+    import tarfile
+    files = {}
+    if not g.is_dir(directory):
+        return files
+    (fd, tarpath) = tempfile.mkstemp(prefix="kvm_image_adjuster.", suffix=".tar")
+    os.close(fd)
+    try:
+        g.tar_out(directory, tarpath)
+        tar = tarfile.open(tarpath)
+        for member in tar.getmembers():
+            name = os.path.normpath(member.name)
+            if member.isfile() and "/" not in name and fnmatch.fnmatch(name, pattern):
+                files[name] = tar.extractfile(member).read()
+        tar.close()
+    finally:
+        os.unlink(tarpath)
+    return files
+
+def guestfs_write_dir(g, directory, files, originals, remove=[]):
+    # writes the files {name: content} of directory that differ from
+    # originals (as returned by guestfs_read_dir) with one tar_in, and
+    # removes the files in remove
+    import tarfile
+    changed = sorted([name for (name, content) in files.items() if originals.get(name) != content])
+    remove = sorted([name for name in remove if name in originals and name not in files])
+    if not changed and not remove:
+        print "  %s not changed" % directory
+        return
+    for name in changed:
+        print "  - %s %s/%s" % ("setting" if name in originals else "creating", directory, name)
+    for name in remove:
+        print "  - removing %s/%s" % (directory, name)
+    if gflags['dry_run']:
+        print "  (dry-run) %d file(s) would be written, %d removed" % (len(changed), len(remove))
+        return
+    if changed:
+        (fd, tarpath) = tempfile.mkstemp(prefix="kvm_image_adjuster.", suffix=".tar")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                tar = tarfile.open(fileobj=f, mode='w')
+                for name in changed:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(files[name])
+                    info.mode = 0644
+                    info.mtime = time.time()
+                    tar.addfile(info, StringIO.StringIO(files[name]))
+                tar.close()
+            for name in changed:
+                g.journal_file(directory + "/" + name, originals.get(name), new=name not in originals)
+            g.tar_in(tarpath, directory)
+        finally:
+            os.unlink(tarpath)
+        for name in changed:
+            g.journal_written(directory + "/" + name, files[name])
+            g.mark_touched(directory + "/" + name)
+    for name in remove:
+        g.journal_file(directory + "/" + name, originals[name])
+        g.rm_f(directory + "/" + name)
+        g.journal_written(directory + "/" + name, None)
+
+def insert_before_lines(content, pattern, new_lines):
+    lines = []
+    for line in content.splitlines(True):
+        if re.search(pattern, line):
+            lines += [l + "\n" for l in new_lines]
+        lines.append(line)
+    return "".join(lines)
+
+def write_file_atomic(path, content):
+    # written to a temporary file next to path and renamed over it, so a
+    # reader (or libvirt) never sees a half written file
+    (fd, tmppath) = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".",
+                                     dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            if os.path.exists(path):
+                os.fchmod(fd, os.stat(path).st_mode & 07777)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.fchmod(fd, 0666 & ~umask)
+            f.write(content)
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath): os.unlink(tmppath)
+        raise
+
+class domain_template:
+    # libvirt domain XML parsed once and instantiated for every clone. the
+    # edit points are compiled once; each instance is a deep copy of the
+    # parsed tree with the name, UUID, disk source/format and MACs replaced.
+    xp_name = xp_uuid = xp_disk = xp_macs = xp_cdrom = None
+    cache = {}
 
-def adjust_xml(xmlfile, **d):
+    @classmethod
+    def compile(cls):
+        from lxml import etree
+        cls.xp_name = etree.XPath("/domain/name")
+        cls.xp_uuid = etree.XPath("/domain/uuid")
+        cls.xp_disk = etree.XPath("/domain/devices/disk[@type='file' and @device='disk']")
+        cls.xp_macs = etree.XPath("/domain/devices/interface/mac")
+        cls.xp_cdrom = etree.XPath("/domain/devices/disk[@device='cdrom']")
+
+    def __init__(self, path):
+        from lxml import etree
+        if self.xp_name is None: self.compile()
+        self.path = path
+        self.doc = etree.parse(path, parser=etree.XMLParser())
+        self.macs = [mac.attrib["address"] for mac in self.xp_macs(self.doc)]
+        uuid = self.xp_uuid(self.doc)
+        self.uuid = uuid[0].text.strip() if uuid and uuid[0].text else None
+
+    @classmethod
+    def load(cls, path):
+        # parsed again only when the file changes, so all clones of a batch
+        # share one golden template
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size, st.st_ino)
+        cached = cls.cache.get(path)
+        if cached is None or cached[0] != key:
+            cached = cls.cache[path] = (key, cls(path))
+        return cached[1]
+
+    def instantiate(self, name, image=None, uuid=None, macs=None, format=None, seed=None):
+        from lxml import etree
+        doc = copy.deepcopy(self.doc)
+        self.xp_name(doc)[0].text = name
+        disk = self.xp_disk(doc)[0]
+        if image:
+            disk.find("source").attrib["file"] = image
+        if format:
+            driver = disk.find("driver")
+            if driver is None:
+                driver = etree.SubElement(disk, "driver", name="qemu")
+            driver.attrib["type"] = format
+        if uuid:
+            self.xp_uuid(doc)[0].text = uuid
+        for i, mac in enumerate(self.xp_macs(doc)):
+            if macs and i < len(macs) and macs[i]:
+                mac.attrib["address"] = macs[i]
+        if seed:
+            # the first cdrom of the template gets the seed, else one is added
+            cdroms = self.xp_cdrom(doc)
+            if cdroms:
+                cdrom = cdroms[0]
+                cdrom.attrib["type"] = "file"
+            else:
+                cdrom = etree.Element("disk", type="file", device="cdrom")
+                etree.SubElement(cdrom, "driver", name="qemu", type="raw")
+                etree.SubElement(cdrom, "target", dev="hdc", bus="ide")
+                etree.SubElement(cdrom, "readonly")
+                cdrom.tail = disk.tail
+                disk.addnext(cdrom)
+            source = cdrom.find("source")
+            if source is None:
+                source = etree.Element("source")
+                cdrom.insert(1 if cdrom.find("driver") is not None else 0, source)
+            source.attrib.clear()
+            source.attrib["file"] = seed
+        return doc
+
+    def render(self, name, **d):
+        from lxml import etree
+        return etree.tostring(self.instantiate(name, **d)) + "\n"
+
+def adjust_xml(xmlfile, template=None, **d):
     print "==> XML configuration of libvirt (%s)" % xmlfile
     print_debug("==> adjust_xml()")
-    orig_xmlfile = xmlfile + ".orig"
-    os.system("mv %s %s" % (xmlfile, orig_xmlfile))
+    template = template or domain_template.load(xmlfile)
     (newname, newext) = os.path.splitext(os.path.basename(xmlfile))
-    newimage = os.path.abspath(d.get("image"))
-    newuuid = d.get("uuid")
-    newmacs = d.get("macs")
-    xml = etree.parse(open(orig_xmlfile, 'r'), parser=etree.XMLParser())
-    image = xml.xpath("/domain/devices/disk[@type='file' and @device='disk']/source/@file")[0]
-    uuid = xml.xpath("/domain/uuid/text()")[0]
-    macs = xml.xpath("/domain/devices/interface/mac/@address")
-    print "  imgpath: %s => %s" % (image, newimage)
-    print "  uuid: %s => %s" % (uuid, newuuid)
-    print "  macs: %s => %s" % (macs, newmacs)
-    xml.xpath("/domain/name")[0].text = newname
-    xml.xpath("/domain/devices/disk[@type='file' and @device='disk']/source")[0].attrib["file"] = newimage
-    xml.xpath("/domain/uuid")[0].text = newuuid
-    for i, mac in enumerate(xml.xpath("/domain/devices/interface/mac")):
-        if not newmacs[i]: continue
-        mac.attrib["address"] = newmacs[i]
-    xml.write(open(xmlfile, 'w'))
+    newimage = os.path.abspath(d.get("image")) if d.get("image") else None
+    disk = template.xp_disk(template.doc)[0]
+    print "  imgpath: %s => %s" % (disk.find("source").attrib["file"], newimage)
+    print "  uuid: %s => %s" % (template.xp_uuid(template.doc)[0].text, d.get("uuid"))
+    print "  macs: %s => %s" % (template.macs, d.get("macs"))
+    if d.get("format"):
+        print "  format: => %s" % d["format"]
+    if d.get("seed"):
+        print "  cdrom: => %s" % d["seed"]
+    content = template.render(newname, image=newimage, uuid=d.get("uuid"),
+                              macs=d.get("macs"), format=d.get("format"), seed=d.get("seed"))
+    if gflags['dry_run']:
+        print "  (dry-run) %s not written" % xmlfile
+        return
+    if os.path.exists(xmlfile):
+        orig_xmlfile = xmlfile + ".orig"
+        if os.path.exists(orig_xmlfile):
+            os.unlink(orig_xmlfile)
+        os.link(xmlfile, orig_xmlfile)
+    write_file_atomic(xmlfile, content)
+
+ISO_SECTOR = 2048
+
+def iso_both16(n):
+    return struct.pack("<H", n) + struct.pack(">H", n)
+
+def iso_both32(n):
+    return struct.pack("<I", n) + struct.pack(">I", n)
+
+def iso_dir_record(name, extent, size, directory, stamp):
+    record = struct.pack("BB", 0, 0) + iso_both32(extent) + iso_both32(size) + \
+        struct.pack("7B", stamp.tm_year - 1900, stamp.tm_mon, stamp.tm_mday,
+                    stamp.tm_hour, stamp.tm_min, stamp.tm_sec, 0) + \
+        struct.pack("BBB", 2 if directory else 0, 0, 0) + iso_both16(1) + chr(len(name)) + name
+    if len(record) % 2: record += "\0"
+    return chr(len(record)) + record[1:]
+
+def iso_volume_descriptor(type, escape, label, text, volume_size, path_table_size, path_tables, root, stamp):
+    date = time.strftime("%Y%m%d%H%M%S00", stamp) + "\0"
+    vd = chr(type) + "CD001\1\0" + text("", 32) + text(label, 32) + "\0" * 8 + iso_both32(volume_size) + \
+        escape.ljust(32, "\0") + iso_both16(1) + iso_both16(1) + iso_both16(ISO_SECTOR) + \
+        iso_both32(path_table_size) + struct.pack("<I", path_tables[0]) + "\0" * 4 + \
+        struct.pack(">I", path_tables[1]) + "\0" * 4 + root + text("", 128) * 4 + text("", 37) * 3 + \
+        date + date + "0" * 16 + "\0" + date + "\1\0"
+    return vd.ljust(ISO_SECTOR, "\0")
+
+def iso_pad(data):
+    return data + "\0" * (-len(data) % ISO_SECTOR)
+
+def make_iso(path, label, files):
+    # minimal ISO9660 image with Joliet names: one root directory holding
+    # files [(name, content)], enough for a cloud-init NoCloud seed without
+    # genisoimage. sectors: 16-17 primary and Joliet volume descriptors,
+    # 18 terminator, 19-22 path tables, 23-24 root directories, then data.
+    stamp = time.gmtime()
+    files = sorted(files)
+    extents = []
+    extent = 25
+    for (name, content) in files:
+        extents.append(extent)
+        extent += max(1, (len(content) + ISO_SECTOR - 1) // ISO_SECTOR)
+    volumes = (
+        (1, "", lambda name: re.sub("[^A-Z0-9_]", "_", name.upper())[:8] + ".;1",
+         lambda text, n: text.ljust(n)[:n], 23, 19),
+        (2, "%/E", lambda name: name.encode("utf-16-be"),
+         lambda text, n: (text.ljust(n // 2).encode("utf-16-be") + "\0")[:n], 24, 21))
+    descriptors = tables = dirs = ""
+    for (type, escape, iso_name, text, root_extent, table_extent) in volumes:
+        root = iso_dir_record("\0", root_extent, ISO_SECTOR, True, stamp)
+        table = struct.pack("<BBIH", 1, 0, root_extent, 1) + "\0\0"
+        descriptors += iso_volume_descriptor(type, escape, label, text, extent, len(table),
+                                             (table_extent, table_extent + 1), root, stamp)
+        tables += iso_pad(table) + iso_pad(struct.pack(">BBIH", 1, 0, root_extent, 1) + "\0\0")
+        records = root + iso_dir_record("\1", root_extent, ISO_SECTOR, True, stamp)
+        for ((name, content), file_extent) in zip(files, extents):
+            records += iso_dir_record(iso_name(name), file_extent, len(content), False, stamp)
+        dirs += iso_pad(records)
+    terminator = iso_pad("\xffCD001\1")
+    data = "\0" * (16 * ISO_SECTOR) + descriptors + terminator + tables + dirs + \
+        "".join([iso_pad(content or "\0") for (name, content) in files])
+    write_file_atomic(path, data)
+
+def yaml_scalar(value):
+    # JSON strings are valid YAML, and quoting keeps MACs from being read as numbers
+    return json.dumps(value)
+
+def nocloud_seed(job):
+    # meta-data, user-data and network-config (version 1) of a NoCloud seed,
+    # from the same options the image is adjusted with
+    hostname = job.get('hostname')
+    meta_data = "instance-id: %s\n" % yaml_scalar(job['uuid'])
+    user_data = "#cloud-config\n"
+    if hostname:
+        meta_data += "local-hostname: %s\n" % yaml_scalar(hostname.split(".")[0])
+        user_data += "hostname: %s\nfqdn: %s\nmanage_etc_hosts: true\n" % (yaml_scalar(hostname.split(".")[0]),
+                                                                         yaml_scalar(hostname))
+    nameservers = job['nameserver'].split(",") if job.get('nameserver') else []
+    domains = job['domain'].split(",") if job.get('domain') else []
+    network = ["version: 1", "config:"]
+    if job.get('network_layout'):
+        network += nocloud_layout(job, job_network_layout(job))
+    new_ifaces = parse_interface_option(job['interface']) if job.get('interface') else {}
+    for i, mac in enumerate(job['macs']):
+        ifname = "eth" + str(i)
+        iface = new_ifaces.get(ifname)
+        if not iface: continue
+        gateway = job.get('gateway') if ifname == job.get('primary') else None
+        network += nocloud_interface("physical", ifname, [("mac_address", mac)], iface['ipaddr'], iface['netmask'],
+                                     gateway)
+    if nameservers or domains:
+        network += ["  - type: nameserver",
+                    "    address: [%s]" % ", ".join([yaml_scalar(ns) for ns in nameservers]),
+                    "    search: [%s]" % ", ".join([yaml_scalar(dom) for dom in domains])]
+    return [("meta-data", meta_data), ("user-data", user_data), ("network-config", "\n".join(network) + "\n")]
+
+def nocloud_interface(type, name, keys, ipaddr, netmask, gateway):
+    # one entry of a version 1 network-config; values of keys are scalars,
+    # lists or dicts
+    lines = ["  - type: %s" % type, "    name: %s" % yaml_scalar(name)]
+    for (key, value) in keys:
+        if isinstance(value, list):
+            lines.append("    %s: [%s]" % (key, ", ".join([yaml_scalar(v) for v in value])))
+        elif isinstance(value, dict):
+            lines.append("    %s:" % key)
+            lines += ["      %s: %s" % (k, yaml_scalar(v)) for (k, v) in sorted(value.items())]
+        else:
+            lines.append("    %s: %s" % (key, yaml_scalar(value)))
+    if ipaddr == "dhcp":
+        lines += ["    subnets:", "      - type: dhcp"]
+    elif ipaddr:
+        lines += ["    subnets:", "      - type: static", "        address: %s" % ipaddr,
+                  "        netmask: %s" % netmask]
+        if gateway: lines.append("        gateway: %s" % gateway)
+    return lines
+
+def nocloud_layout(job, layout):
+    # the --network-layout as cloud-init sees it: physical NICs by their new
+    # MAC, bonds, VLANs and bridges
+    template = domain_template.load(job_xml_template(job))
+    new_macs = dict([(iface['name'], newmac) for (iface, oldmac, newmac) in layout.nics(template.macs, job['macs'])])
+    primary = layout.primary or job.get('primary')
+    gateway = layout.gateway or job.get('gateway')
+    lines = []
+    for iface in layout.ordered():
+        name = iface['name']
+        if iface['type'] == "ethernet":
+            (type, keys) = ("physical", [("mac_address", new_macs[name])])
+        elif iface['type'] == "bond":
+            params = dict([("bond-" + key.replace("_", "-"), value) for (key, sep, value) in
+                           [option.partition("=") for option in iface['options'].split()]])
+            (type, keys) = ("bond", [("bond_interfaces", layout.members('master', name)), ("params", params)])
+        elif iface['type'] == "vlan":
+            (type, keys) = ("vlan", [("vlan_link", iface['device']), ("vlan_id", int(iface['id']))])
+        else:
+            (type, keys) = ("bridge", [("bridge_interfaces", layout.members('bridge', name))])
+        (ipaddr, netmask) = layout.address(iface, job.get('addresses') or {})
+        lines += nocloud_interface(type, name, keys, ipaddr, netmask, gateway if name == primary else None)
+    return lines
+
+def seed_path(job):
+    return os.path.splitext(job['xmlpath'])[0] + ".seed.iso"
+
+def make_seed(job):
+    # the guest applies its own settings with cloud-init at first boot.
+    # without --interface or a base image, allocate() leaves the domain its
+    # UUID and MACs
+    template = domain_template.load(job_xml_template(job))
+    if not job.get('uuid'): job['uuid'] = template.uuid
+    if not job.get('macs'): job['macs'] = template.macs
+    path = seed_path(job)
+    files = nocloud_seed(job)
+    print "==> NoCloud seed (%s)" % path
+    for (name, content) in files:
+        print_debug("  %s:\n%s" % (name, content))
+    if gflags['dry_run']:
+        print "  (dry-run) %s not written" % path
+    else:
+        make_iso(path, "cidata", files)
+    job['seed'] = os.path.abspath(path)
+
+def seed_image(job):
+    make_seed(job)
+    adjust_xml(job['xmlpath'], template=domain_template.load(job_xml_template(job)), image=job['imgpath'],
+               uuid=job['uuid'], macs=job['macs'], format=job.get('image_format'), seed=job['seed'])
+
+def libvirt_open(uri):
+    # libvirt-python is only needed when domains are defined
+    import libvirt
+    conn = libvirt.open(uri)
+    if conn is None:
+        raise RuntimeError("failed to open connection to %s" % uri)
+    return conn
+
+def define_domain(conn, xmlpath):
+    dom = conn.defineXML(open(xmlpath).read())
+    print "  defined %s: %s" % (dom.name(), xmlpath)
+
+def define_domains(uri, xmlpaths):
+    # one connection for the whole batch
+    print "=> define %d domain(s) on %s" % (len(xmlpaths), uri)
+    conn = libvirt_open(uri)
+    try:
+        for xmlpath in xmlpaths:
+            define_domain(conn, xmlpath)
+    finally:
+        conn.close()
 
 def linux_adjust_udev_rules(g, ifcfgs):
     print_debug("==> linux_adjust_udev_rules(): %s" % ifcfgs)
@@ -303,24 +1707,32 @@ def linux_adjust_udev_rules(g, ifcfgs):
     if not g.is_file(udev_net_rule):
         print_debug("linux_adjust_udev_rules(): %s is not file." % udev_net_rule)
         return
-    orig_udev_net_rule = udev_net_rule + ".orig"
-    g.mv(udev_net_rule, orig_udev_net_rule)
-    sed_command = "sed"
-    for ifname in sorted(ifcfgs.keys()):
-        sed_command += " -e 's|\(ATTR{address}==\)\"%s\", |\\1\"%s\", |'" % (ifcfgs[ifname].mac, ifcfgs[ifname].newmac)
-    sed_command += " %s > %s" % (orig_udev_net_rule, udev_net_rule)
-    print_debug("  command: %s" % sed_command)
-    g.sh(sed_command)
+    macs = dict([(ifcfg.mac, ifcfg.newmac) for ifcfg in ifcfgs.values() if ifcfg.mac and ifcfg.newmac])
+    print_debug("  macs: %s" % macs)
+    def replace_mac(m):
+        return '%s"%s", ' % (m.group(1), macs.get(m.group(2).lower(), m.group(2)))
+    guestfs_rewrite_file(g, udev_net_rule,
+                         lambda content: re.sub(r'(ATTR\{address\}==)"([^"]*)", ', replace_mac, content))
 
 def rhel_adjust_resolvconf(g, nameservers, domains):
     print_debug("==> rhel_adjust_resolvconf()")
     path = "/etc/resolv.conf"
     print "==> resolver (%s)" % path
     augpath = "/files" + path
+    nameservers = nameservers or []
+    domains = domains or []
     if not g.exists(path):
         print "  %s not exists, creating..." % path
-        g.sh("touch %s" % path)
+        if not gflags['dry_run']:
+            g.journal_file(path)
+            g.touch(path)
+            g.mark_touched(path)
     else:
+        current_nameservers = [g.aug_get(p) for p in g.aug_match(augpath + "/nameserver")]
+        current_domains = [g.aug_get(p) for p in g.aug_match(augpath + "/search/domain")]
+        if current_nameservers == nameservers and current_domains == domains:
+            print "  %s not changed" % path
+            return
         print "  %s exists, deleting existing entries..." % path
         g.aug_rm(augpath + "/nameserver")
         g.aug_rm(augpath + "/search")
@@ -338,23 +1750,26 @@ def rhel_adjust_resolvconf(g, nameservers, domains):
             else:
                 g.aug_insert(augpath + "/search/domain[last()]", "domain", 0)
                 g.aug_set(augpath + "/search/domain[last()]", dom)
-    g.aug_save()
 
 def rhel_adjust_ifaces(g, defined_macs, new_ifaces, new_macs, nameservers, domains, primary, gateway):
     print_debug("==> rhel_adjust_ifaces()")
+    snapshot = ifcfg_rhel_snapshot(g)
     for i, mac in enumerate(defined_macs):
         ifname = "eth" + str(i)
         print "==> %s" % ifname
         new_iface = new_ifaces.get(ifname)
-        ifcfgs[ifname] = ifcfg_rhel(g, ifname)
+        ifcfgs[ifname] = ifcfg_rhel(g, ifname, snapshot)
+        g.aug_known(ifcfgs[ifname].augpath, snapshot.get(ifname, {}))
         is_primary = (ifname == primary)
+        # the connection keeps its UUID as long as the NIC keeps its MAC
+        new_uuid = generate_new_uuid() if new_macs[i] != ifcfgs[ifname].mac else None
         if not new_iface:
             ifcfgs[ifname].prepare(mac=new_macs[i],
-                                   uuid=generate_new_uuid())
+                                   uuid=new_uuid)
         else:
             ifcfgs[ifname].prepare(bootproto  = "static" if new_iface['ipaddr'] != "dhcp" else "dhcp",
                                    mac        = new_macs[i],
-                                   uuid       = generate_new_uuid(),
+                                   uuid       = new_uuid,
                                    ipaddr     = new_iface['ipaddr'] if new_iface['ipaddr'] != "dhcp" else None,
                                    netmask    = new_iface['netmask'] if new_iface['ipaddr'] != "dhcp" else None,
                                    primary    = is_primary,
@@ -370,9 +1785,9 @@ def rhel_adjust_hostname(g, new_hostname):
     print "==> hostname (%s)" % path
     augpath = "/files" + path + "/HOSTNAME"
     old_hostname = g.aug_get(augpath)
+    g.aug_known("/files" + path, {"HOSTNAME": old_hostname}, complete=False)
     print_debug("  %s => %s" % (old_hostname, new_hostname))
     g.aug_set(augpath, new_hostname)
-    g.aug_save()
 
 def rhel_adjust_grub(g):
     print_debug("==> rhel_adjust_grub()")
@@ -401,26 +1816,22 @@ def rhel_adjust_grub(g):
         g.aug_set(augpath + "/terminal/timeout", "5")
         g.aug_clear(augpath + "/terminal/serial")
         g.aug_clear(augpath + "/terminal/console")
-
-    g.aug_save()
     
 def rhel_adjust_upstart(g):
     print_debug("==> rhel_adjust_upstart()")
     conf = "/etc/init/start-ttys.conf"
-    orig_conf = conf + ".orig"
-    if g.egrep("\s+initctl\s+start\s+serial\s+DEV=[^\s]+\s+SPEED=[0-9]+", conf):
-        print "  %s already has serial console configuration, skipping..." % conf
-    else:
-        command = "sed '/end script/i \	initctl start serial DEV=ttyS0 SPEED=115200'"
-        g.mv(conf, orig_conf)
-        g.sh(command + " %s > %s" % (orig_conf, conf))
+    def rewrite(content):
+        if re.search(r"\s+initctl\s+start\s+serial\s+DEV=[^\s]+\s+SPEED=[0-9]+", content):
+            print "  %s already has serial console configuration, skipping..." % conf
+            return content
+        return insert_before_lines(content, "end script", ["\tinitctl start serial DEV=ttyS0 SPEED=115200"])
+    guestfs_rewrite_file(g, conf, rewrite)
 
 def rhel_adjust_inittab(g):
     print_debug("==> rhel_adjust_inittab()")
     path = "/etc/inittab"
     print "==> inittab (%s)" % path
     g.aug_set("/files" + path + "/id/runlevels", "3")
-    g.aug_save()
 
 def rhel_adjust_misc(g):
     print "==> misc configuration"
@@ -429,19 +1840,17 @@ def rhel_adjust_misc(g):
     augpath = "/files" + path
     g.aug_set(augpath + "/NETWORKING", "yes")
     g.aug_set(augpath + "/NETWORKING_IPV6", "no")
-    g.aug_save()
-
-def get_all_macs_from_xml(xmlfile):
-    xml = etree.parse(open(xmlfile, 'r'), parser=etree.XMLParser())
-    return xml.xpath("/domain/devices/interface/mac/@address")
 
 def ubuntu_adjust_ifaces(g, defined_macs, new_ifaces, new_macs, nameservers, domains, primary, gateway):
     print_debug("==> ubuntu_adjust_ifaces()")
+    snapshot = ifcfg_ubuntu_snapshot(g)
+    for entry in snapshot.values():
+        g.aug_known(entry['augpath'], dict([(key, value) for (key, value) in entry.items() if key != 'augpath']))
     for i, mac in enumerate(defined_macs):
         ifname = "eth" + str(i)
         print "==> %s" % ifname
         new_iface = new_ifaces.get(ifname)
-        ifcfgs[ifname] = ifcfg_ubuntu(g, ifname)
+        ifcfgs[ifname] = ifcfg_ubuntu(g, ifname, snapshot)
         is_primary = (ifname == primary)
         if not new_iface:
             continue
@@ -455,33 +1864,188 @@ def ubuntu_adjust_ifaces(g, defined_macs, new_ifaces, new_macs, nameservers, dom
         ifcfgs[ifname].info()
         ifcfgs[ifname].commit_update()
 
+def parse_shellvars(content, unquote=True):
+    # KEY=VALUE lines of an ifcfg file, unquoted or as augeas shows them
+    values = {}
+    for m in re.finditer(r'(?m)^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)=(.*)$', content):
+        value = m.group(2).strip()
+        values[m.group(1)] = value.strip('"\'') if unquote else value
+    return values
+
+def linux_render_udev_rules(content, nics):
+    # one rule per NIC of the layout naming it by its new MAC. the rules of
+    # its old and new MAC and of its name are replaced, the others kept
+    macs = set([mac for (iface, oldmac, newmac) in nics for mac in (oldmac, newmac)])
+    names = set([iface['name'] for (iface, oldmac, newmac) in nics])
+    lines = []
+    for line in content.splitlines(True):
+        address = re.search(r'ATTR\{address\}=="([^"]*)"', line)
+        name = re.search(r'NAME="([^"]*)"', line)
+        if (address and address.group(1).lower() in macs) or (name and name.group(1) in names):
+            continue
+        lines.append(line if line.endswith("\n") else line + "\n")
+    for (iface, oldmac, newmac) in nics:
+        lines.append('SUBSYSTEM=="net", ACTION=="add", DRIVERS=="?*", ATTR{address}=="%s", ATTR{type}=="1", '
+                     'KERNEL=="eth*", NAME="%s"\n' % (newmac, iface['name']))
+    return "".join(lines)
+
+def linux_adjust_layout_udev_rules(g, nics):
+    udev_net_rule = "/etc/udev/rules.d/70-persistent-net.rules"
+    print "==> udev rules (%s)" % udev_net_rule
+    render = lambda content: linux_render_udev_rules(content, nics)
+    if g.is_file(udev_net_rule):
+        guestfs_rewrite_file(g, udev_net_rule, render)
+    else:
+        guestfs_write_file(g, udev_net_rule, render(""))
+
+def rhel_render_ifcfg(iface, mac, uuid, ipaddr, netmask, primary, gateway, nameservers, domains):
+    keys = [("DEVICE", iface['name'])]
+    if iface['type'] == "ethernet":
+        keys += [("TYPE", "Ethernet"), ("HWADDR", mac)]
+    elif iface['type'] == "bond":
+        keys += [("TYPE", "Bond"), ("BONDING_MASTER", "yes"), ("BONDING_OPTS", iface['options'])]
+    elif iface['type'] == "vlan":
+        keys += [("VLAN", "yes"), ("PHYSDEV", iface['device'])]
+    elif iface['type'] == "bridge":
+        keys += [("TYPE", "Bridge")]
+    if uuid: keys.append(("UUID", uuid))
+    if iface.get('master'): keys += [("MASTER", iface['master']), ("SLAVE", "yes")]
+    if iface.get('bridge'): keys.append(("BRIDGE", iface['bridge']))
+    keys.append(("BOOTPROTO", "dhcp" if ipaddr == "dhcp" else "static" if ipaddr else "none"))
+    if ipaddr and ipaddr != "dhcp": keys += [("IPADDR", ipaddr), ("NETMASK", netmask)]
+    if iface['name'] == primary:
+        if gateway: keys.append(("GATEWAY", gateway))
+        for (i, ns) in enumerate((nameservers or [])[:2]): keys.append(("DNS%d" % (i + 1), ns))
+        if domains: keys.append(("DOMAIN", " ".join(domains)))
+    keys += [("NM_CONTROLLED", "no"), ("ONBOOT", "yes"), ("USERCTL", "no"), ("PEERDNS", "no"), ("IPV6INIT", "no")]
+    return "".join(['%s="%s"\n' % kv for kv in keys])
+
+def rhel_adjust_network(g, layout, nics, addresses, nameservers, domains, primary, gateway):
+    # every ifcfg file of the layout is rendered in python; the changed ones
+    # are written with one tar_in, whatever the number of interfaces
+    print_debug("==> rhel_adjust_network()")
+    directory = "/etc/sysconfig/network-scripts"
+    print "==> network layout %s (%s)" % (layout.path, directory)
+    originals = guestfs_read_dir(g, directory, "ifcfg-*")
+    current = dict([(name[len("ifcfg-"):], parse_shellvars(content)) for (name, content) in originals.items()])
+    new_macs = dict([(iface['name'], newmac) for (iface, oldmac, newmac) in nics])
+    macs = set([mac for (iface, oldmac, newmac) in nics for mac in (oldmac, newmac)])
+    files = {}
+    for iface in layout.ordered():
+        name = iface['name']
+        old = current.get(name, {})
+        # as with --interface, the connection keeps its UUID as long as the NIC keeps its MAC
+        uuid = old.get("UUID")
+        if not uuid or (name in new_macs and old.get("HWADDR", "").lower() != new_macs[name]):
+            uuid = generate_new_uuid()
+        (ipaddr, netmask) = layout.address(iface, addresses)
+        files["ifcfg-" + name] = rhel_render_ifcfg(iface, new_macs.get(name), uuid, ipaddr, netmask,
+                                                  primary, gateway, nameservers, domains)
+    # a NIC of the layout configured under another name in the template
+    stale = ["ifcfg-" + name for (name, values) in current.items()
+             if name not in layout.by_name and values.get("HWADDR", "").lower() in macs]
+    guestfs_write_dir(g, directory, files, originals, stale)
+    linux_adjust_layout_udev_rules(g, nics)
+
+def ubuntu_render_stanza(iface, layout, ipaddr, netmask, primary, gateway, nameservers, domains):
+    method = "dhcp" if ipaddr == "dhcp" else "static" if ipaddr else "manual"
+    options = []
+    if method == "static": options += [("address", ipaddr), ("netmask", netmask)]
+    if iface.get('master'): options.append(("bond-master", iface['master']))
+    if iface['type'] == "bond":
+        options.append(("bond-slaves", "none"))
+        for option in iface['options'].split():
+            (key, sep, value) = option.partition("=")
+            options.append(("bond-" + key.replace("_", "-"), value))
+    elif iface['type'] == "vlan":
+        options.append(("vlan-raw-device", iface['device']))
+    elif iface['type'] == "bridge":
+        options.append(("bridge_ports", " ".join(layout.members('bridge', iface['name'])) or "none"))
+    if iface['name'] == primary:
+        if gateway: options.append(("gateway", gateway))
+        if nameservers: options.append(("dns-nameservers", " ".join(nameservers)))
+        if domains: options.append(("dns-search", " ".join(domains)))
+    return "".join(["auto %s\n" % iface['name'], "iface %s inet %s\n" % (iface['name'], method)] +
+                   ["    %s %s\n" % option for option in options])
+
+def ubuntu_strip_stanzas(content, names):
+    # content without the auto/allow-* entries and iface stanzas of names
+    lines = []
+    skipping = False
+    for line in content.splitlines(True):
+        words = line.split()
+        if words and words[0] in ("iface", "mapping", "source", "source-directory"):
+            skipping = words[0] == "iface" and len(words) > 1 and words[1] in names
+        elif words and words[0].startswith("#") and not line[0].isspace():
+            skipping = False
+        elif words and (words[0] == "auto" or words[0].startswith("allow-")):
+            skipping = False
+            kept = [word for word in words[1:] if word not in names]
+            if len(kept) < len(words) - 1:
+                if kept: lines.append(" ".join([words[0]] + kept) + "\n")
+                continue
+        if not skipping:
+            lines.append(line)
+    return "".join(lines)
+
+def ubuntu_adjust_network(g, layout, nics, addresses, nameservers, domains, primary, gateway):
+    # /etc/network/interfaces is rewritten once with a stanza per interface
+    # of the layout; the stanzas of other interfaces (lo) are kept
+    print_debug("==> ubuntu_adjust_network()")
+    path = "/etc/network/interfaces"
+    print "==> network layout %s (%s)" % (layout.path, path)
+    stanzas = []
+    for iface in layout.ordered():
+        (ipaddr, netmask) = layout.address(iface, addresses)
+        stanzas.append(ubuntu_render_stanza(iface, layout, ipaddr, netmask, primary, gateway, nameservers, domains))
+    # a NIC of the layout named otherwise by the udev rules of the template
+    macs = set([mac for (iface, oldmac, newmac) in nics for mac in (oldmac, newmac)])
+    udev_net_rule = "/etc/udev/rules.d/70-persistent-net.rules"
+    stale = []
+    if g.is_file(udev_net_rule):
+        for line in g.read_lines(udev_net_rule):
+            address = re.search(r'ATTR\{address\}=="([^"]*)"', line)
+            name = re.search(r'NAME="([^"]*)"', line)
+            if address and name and address.group(1).lower() in macs and name.group(1) not in layout.by_name:
+                stale.append(name.group(1))
+    def render(content):
+        kept = ubuntu_strip_stanzas(content, layout.by_name.keys() + stale).rstrip("\n")
+        return (kept + "\n" if kept else "") + "".join(["\n" + stanza for stanza in stanzas])
+    if g.is_file(path):
+        guestfs_rewrite_file(g, path, render)
+    else:
+        guestfs_write_file(g, path, render(""))
+    linux_adjust_layout_udev_rules(g, nics)
+
 def ubuntu_adjust_hostname(g, new_hostname):
     print_debug("==> ubuntu_adjust_hostname()")
     conf = "/etc/hostname"
     print "==> hostname (%s)" % conf
     hostname = g.read_lines(conf)[0]
     print_debug("  %s => %s" % (hostname, new_hostname))
+    if hostname == new_hostname:
+        print "  %s not changed" % conf
+        return
     guestfs_write_file(g, conf, new_hostname)
     
 def ubuntu_adjust_grub(g):
     print_debug("==> ubuntu_adjust_grub()")
     conf = "/etc/default/grub"
     print "==> grub configuration (%s)" % conf
-    orig_conf = conf + ".adjuster_orig"
-    if g.egrep("GRUB_CMDLINE_LINUX.*tty", conf):
-        print "  grub already has serial console configuration, skipping..."
-    else:
-        command = "sed"
-        command += " -e 's/^GRUB_CMDLINE_LINUX=\"\\(.*\\)\"/GRUB_CMDLINE_LINUX=\"\\1 console=tty0 console=ttyS0,115200n8\"/'"
-        command += " -e '/^GRUB_CMDLINE_LINUX=/i GRUB_TERMINAL=serial'"
-        command += " -e '/^GRUB_CMDLINE_LINUX=/i GRUB_SERIAL_COMMAND=\"serial --speed=115200 --unit=0 --word=8 --parity=no --stop=1\"'"
-        command += " %s > %s" % (orig_conf, conf)
-        print_debug("  running sed...")
-        print_debug("    command: %s" % command)
-        g.mv(conf, orig_conf)
-        g.sh(command)
+    def rewrite(content):
+        if re.search("GRUB_CMDLINE_LINUX.*tty", content):
+            print "  grub already has serial console configuration, skipping..."
+            return content
+        content = re.sub(r'(?m)^GRUB_CMDLINE_LINUX="(.*)"',
+                         r'GRUB_CMDLINE_LINUX="\1 console=tty0 console=ttyS0,115200n8"', content)
+        return insert_before_lines(content, "^GRUB_CMDLINE_LINUX=",
+                                   ["GRUB_TERMINAL=serial",
+                                    'GRUB_SERIAL_COMMAND="serial --speed=115200 --unit=0 --word=8 --parity=no --stop=1"'])
+    if guestfs_rewrite_file(g, conf, rewrite) and not gflags['dry_run']:
         print_debug("  running update-grub...")
+        g.journal_file("/boot/grub/grub.cfg")
         g.sh("update-grub")
+        g.mark_touched("/boot/grub/grub.cfg")
 
 def ubuntu_adjust_upstart(g):
     print_debug("==> ubuntu_adjust_upstart()")
@@ -502,9 +2066,68 @@ def ubuntu_adjust_inittab(g): pass
 def ubuntu_adjust_resolvconf(g, nameservers, domains): pass
 def ubuntu_adjust_misc(g): pass
 
+def linux_read_udev_rules(g):
+    # {ifname: mac} of the persistent net rules
+    path = "/etc/udev/rules.d/70-persistent-net.rules"
+    rules = {}
+    if not g.is_file(path):
+        return rules
+    for line in g.read_lines(path):
+        mac = re.search(r'ATTR\{address\}=="([^"]*)"', line)
+        name = re.search(r'NAME="([^"]*)"', line)
+        if mac and name:
+            rules[name.group(1)] = mac.group(1).lower()
+    return rules
+
+def aug_get_first(g, augpath):
+    matches = g.aug_match(augpath)
+    return g.aug_get(matches[0]) if matches else None
+
+def rhel_verify_image(g):
+    print_debug("==> rhel_verify_image()")
+    snapshot = ifcfg_rhel_snapshot(g)
+    interfaces = {}
+    for ifname in sorted(snapshot):
+        if not re.match(r"eth[0-9]+$", ifname): continue
+        ifcfg = ifcfg_rhel(g, ifname, snapshot)
+        interfaces[ifname] = {'mac': ifcfg.mac, 'bootproto': ifcfg.bootproto,
+                              'ipaddr': ifcfg.ipaddr, 'netmask': ifcfg.netmask}
+    grub = "/files/boot/grub/menu.lst"
+    default = aug_get_first(g, grub + "/default") or "0"
+    conf = "/etc/init/start-ttys.conf"
+    getty = g.is_file(conf) and \
+        re.search(r"\s+initctl\s+start\s+serial\s+DEV=ttyS0", g.read_file(conf)) is not None
+    return {'hostname': aug_get_first(g, "/files/etc/sysconfig/network/HOSTNAME"),
+            'interfaces': interfaces,
+            'nameservers': [g.aug_get(p) for p in g.aug_match("/files/etc/resolv.conf/nameserver")],
+            'serial_console': {'grub': len(g.aug_match(grub + "/title[%d]/kernel/console" % (int(default) + 1))) > 0,
+                               'getty': getty},
+            'runlevel': aug_get_first(g, "/files/etc/inittab/id/runlevels")}
+
+def ubuntu_verify_image(g):
+    print_debug("==> ubuntu_verify_image()")
+    snapshot = ifcfg_ubuntu_snapshot(g)
+    interfaces = {}
+    for ifname in sorted(snapshot):
+        if not re.match(r"eth[0-9]+$", ifname): continue
+        ifcfg = ifcfg_ubuntu(g, ifname, snapshot)
+        # the MAC of an interface is only known from the udev rules
+        interfaces[ifname] = {'mac': None, 'bootproto': ifcfg.bootproto,
+                              'ipaddr': ifcfg.ipaddr, 'netmask': ifcfg.netmask}
+    conf = "/etc/default/grub"
+    resolvconf = g.read_file("/etc/resolv.conf") if g.is_file("/etc/resolv.conf") else ""
+    return {'hostname': g.read_lines("/etc/hostname")[0] if g.is_file("/etc/hostname") else None,
+            'interfaces': interfaces,
+            'nameservers': re.findall(r"(?m)^\s*nameserver\s+(\S+)", resolvconf),
+            'serial_console': {'grub': g.is_file(conf) and
+                                       re.search("GRUB_CMDLINE_LINUX.*ttyS0", g.read_file(conf)) is not None,
+                               'getty': g.exists("/etc/init/ttyS0.conf")},
+            'runlevel': None}
+
 adjust_ops = {
     'linux-rhel-6': {
         'adjust_ifaces': rhel_adjust_ifaces,
+        'adjust_network': rhel_adjust_network,
         'adjust_udev_rules': linux_adjust_udev_rules,
         'adjust_hostname': rhel_adjust_hostname,
         'adjust_xml': adjust_xml,
@@ -513,9 +2136,11 @@ adjust_ops = {
         'adjust_inittab': rhel_adjust_inittab,
         'adjust_resolvconf': rhel_adjust_resolvconf,
         'adjust_misc': rhel_adjust_misc,
+        'verify_image': rhel_verify_image,
     },
     'linux-ubuntu-12': {
         'adjust_ifaces': ubuntu_adjust_ifaces,
+        'adjust_network': ubuntu_adjust_network,
         'adjust_udev_rules': linux_adjust_udev_rules,
         'adjust_hostname': ubuntu_adjust_hostname,
         'adjust_xml': adjust_xml,
@@ -524,8 +2149,107 @@ adjust_ops = {
         'adjust_inittab': ubuntu_adjust_inittab,
         'adjust_resolvconf': ubuntu_adjust_resolvconf,
         'adjust_misc': ubuntu_adjust_misc,
+        'verify_image': ubuntu_verify_image,
+    },
+}
+
+# files (and their augeas lens) each operation reads or writes through augeas
+aug_files = {
+    'linux-rhel-6': {
+        'adjust_ifaces': [("Shellvars", "/etc/sysconfig/network-scripts/ifcfg-*")],
+        'adjust_hostname': [("Shellvars", "/etc/sysconfig/network")],
+        'adjust_grub': [("Grub", "/boot/grub/menu.lst")],
+        'adjust_inittab': [("Inittab", "/etc/inittab")],
+        'adjust_resolvconf': [("Resolv", "/etc/resolv.conf")],
+        'adjust_misc': [("Shellvars", "/etc/sysconfig/network")],
+        'verify_image': [("Shellvars", "/etc/sysconfig/network-scripts/ifcfg-*"),
+                         ("Shellvars", "/etc/sysconfig/network"),
+                         ("Grub", "/boot/grub/menu.lst"),
+                         ("Inittab", "/etc/inittab"),
+                         ("Resolv", "/etc/resolv.conf")],
+    },
+    'linux-ubuntu-12': {
+        'adjust_ifaces': [("Interfaces", "/etc/network/interfaces")],
+        'verify_image': [("Interfaces", "/etc/network/interfaces")],
+    },
+}
+
+# operations that give the same result on every clone: prepare-base applies
+# them once to the golden image, and clones of it skip them
+invariant_ops = ['adjust_grub', 'adjust_upstart', 'adjust_inittab', 'adjust_misc']
+
+# files whose content is the result of each clone-invariant operation,
+# checksummed in the base fingerprint
+base_files = {
+    'linux-rhel-6': {
+        'adjust_grub': ["/boot/grub/menu.lst"],
+        'adjust_upstart': ["/etc/init/start-ttys.conf"],
+        'adjust_inittab': ["/etc/inittab"],
+        'adjust_misc': ["/etc/sysconfig/network"],
+    },
+    'linux-ubuntu-12': {
+        'adjust_grub': ["/etc/default/grub", "/boot/grub/grub.cfg"],
+        'adjust_upstart': ["/etc/init/ttyS0.conf"],
+    },
+}
+
+# guest paths each operation reads or writes, through augeas or not,
+# including what the commands it runs in the guest need. only the
+# filesystems holding them are mounted; verify_image and rollback may
+# touch any of them.
+op_paths = {
+    'linux-rhel-6': {
+        'adjust_ifaces': ["/etc/sysconfig/network-scripts"],
+        'adjust_network': ["/etc/sysconfig/network-scripts", "/etc/udev/rules.d"],
+        'adjust_udev_rules': ["/etc/udev/rules.d"],
+        'adjust_hostname': ["/etc/sysconfig/network"],
+        'adjust_grub': ["/boot/grub"],
+        'adjust_upstart': ["/etc/init"],
+        'adjust_inittab': ["/etc/inittab"],
+        'adjust_resolvconf': ["/etc/resolv.conf"],
+        'adjust_misc': ["/etc/sysconfig/network"],
+    },
+    'linux-ubuntu-12': {
+        'adjust_ifaces': ["/etc/network/interfaces"],
+        'adjust_network': ["/etc/network/interfaces", "/etc/udev/rules.d"],
+        'adjust_udev_rules': ["/etc/udev/rules.d"],
+        'adjust_hostname': ["/etc/hostname"],
+        # update-grub
+        'adjust_grub': ["/etc/default/grub", "/etc/grub.d", "/boot/grub", "/usr"],
+        'adjust_upstart': ["/etc/init"],
     },
 }
+for ops in op_paths.values():
+    ops['verify_image'] = ops['rollback'] = sorted(set([path for paths in ops.values() for path in paths]))
+
+# base fingerprint and undo journal, written on every run
+common_paths = [os.path.dirname(BASE_FINGERPRINT)]
+
+def mount_paths_for_ops(os, opnames):
+    # None: mount every filesystem
+    os_major = re.sub('-[^-]+$', '', os)
+    if opnames is None or os_major not in op_paths:
+        return None
+    paths = list(common_paths)
+    for opname in opnames:
+        for path in op_paths[os_major].get(opname, []):
+            if path not in paths: paths.append(path)
+    return paths
+
+def path_on_mount_point(path, mount_point):
+    # path is on the filesystem mounted at mount_point or on one mounted
+    # below it, which needs mount_point mounted first
+    return mount_point == "/" or path == mount_point or path.startswith(mount_point + "/")
+
+def aug_files_for_ops(os, opnames):
+    os_major = re.sub('-[^-]+$', '', os)
+    if opnames is None or os_major not in aug_files:
+        return None
+    files = []
+    for opname in opnames:
+        for f in aug_files[os_major].get(opname, []):
+            if f not in files: files.append(f)
+    return files
 
 def adjuster(os, opname):
     os_major = re.sub('-[^-]+$', '', os)
@@ -535,16 +2259,690 @@ def adjuster(os, opname):
         print "OS not supported:", os
         sys.exit(1)
     op = ops.get(opname)
+    if opname in gflags['base_ops']:
+        print "==> %s: done in the base image, skipping..." % opname
+        return lambda *args: None
     if not op:
         print "Operation (%s) not defined, skipping..." % opname
     print_debug("  op: %s" % op)
-    return op
+    return profile_phase(opname)(op) if op else op
+
+def base_plan_ops(job):
+    # clone-invariant operations prepare-base runs for job
+    return [opname for opname in invariant_ops if job.get('serial_console') or opname == 'adjust_misc']
+
+def prepare_base_image(g, job):
+    print_debug("==> prepare_base_image(): %s" % job)
+    g = aug_transaction(g)
+    OS = gflags['os']
+    opnames = base_plan_ops(job)
+    print "=> prepare base image"
+    for opname in opnames:
+        adjuster(OS, opname)(g)
+    g.commit()
+    guestfs_write_base(g, OS, opnames)
+    g.write_journal()
+    guestfs_relabel(g, g.touched)
+
+def plan_ops(job):
+    # operations adjust_image() runs for job
+    opnames = []
+    if job.get('interface') or job.get('base_image') or job.get('network_layout'):
+        # the layout engine writes the udev rules with the interfaces
+        opnames += ['adjust_network'] if job.get('network_layout') else ['adjust_ifaces', 'adjust_udev_rules']
+        if job.get('hostname'): opnames.append('adjust_hostname')
+        opnames += ['adjust_resolvconf', 'adjust_xml', 'adjust_misc']
+    if job.get('serial_console'):
+        opnames += ['adjust_grub', 'adjust_upstart', 'adjust_inittab']
+    return opnames
+
+def adjust_image(g, job):
+    print_debug("==> adjust_image(): %s" % job)
+    ifcfgs.clear()
+    g = aug_transaction(g)
+    OS = gflags['os']
+
+    # a clone always needs new MACs/UUID, even if no interface is reconfigured
+    if job.get('interface') or job.get('base_image') or job.get('network_layout'):
+        template = domain_template.load(job_xml_template(job))
+        defined_macs = template.macs
+        new_ifaces = parse_interface_option(job['interface']) if job.get('interface') else {}
+        # decided by allocate() when the job comes from the command line
+        new_macs = job.get('macs') or generate_new_macs(defined_macs, new_ifaces)
+        nameservers = job['nameserver'].split(",") if job.get('nameserver') else None
+        domains = job['domain'].split(",") if job.get('domain') else None
+
+        print "=> adjust interfaces (img)"
+        if job.get('network_layout'):
+            layout = job_network_layout(job)
+            adjuster(OS, 'adjust_network')(g, layout, layout.nics(defined_macs, new_macs), job.get('addresses') or {},
+                                           nameservers, domains, layout.primary or job.get('primary'),
+                                           layout.gateway or job.get('gateway'))
+        else:
+            adjuster(OS, 'adjust_ifaces')(g, defined_macs, new_ifaces, new_macs,
+                                          nameservers, domains, job.get('primary'), job.get('gateway'))
+            adjuster(OS, 'adjust_udev_rules')(g, ifcfgs)
+        if job.get('hostname'):
+            adjuster(OS, 'adjust_hostname')(g, job['hostname'])
+        adjuster(OS, 'adjust_resolvconf')(g, nameservers, domains)
+        print "=> adjust interfaces (xml)"
+        # with the local backend the image is a root tree, not a disk the domain can use
+        image = job['imgpath'] if gflags['backend'] != "local" else None
+        # the clone pipeline renders the XML in a stage of its own
+        if not job.get('defer_xml'):
+            adjuster(OS, 'adjust_xml')(job['xmlpath'], template=template, image=image, uuid=job.get('uuid') or generate_new_uuid(),
+                                       macs=new_macs, format=job.get('image_format'))
+        adjuster(OS, 'adjust_misc')(g)
+
+    if job.get('serial_console'):
+        print "=> adjust for serial console"
+        adjuster(OS, 'adjust_grub')(g)
+        adjuster(OS, 'adjust_upstart')(g)
+        adjuster(OS, 'adjust_inittab')(g)
+
+    g.commit()
+    g.write_journal()
+    guestfs_relabel(g, g.touched)
+
+def run_job(job, func, *args):
+    start = time.time()
+    result = {'imgpath': job.get('imgpath'), 'status': 'ok', 'error': None}
+    try:
+        report = func(*args)
+        if report is not None: result['report'] = report
+    except (Exception, SystemExit) as e:
+        print "** %s: %s" % (job.get('imgpath'), e)
+        result['status'] = 'failed'
+        result['error'] = "%s: %s" % (e.__class__.__name__, e)
+    result['elapsed'] = time.time() - start
+    return result
+
+def raise_error(e):
+    raise e
+
+def guestfs_abort(g):
+    # drop unsaved augeas changes and release the mounts of a failed image
+    for func in (g.aug_close, g.umount_all):
+        try:
+            func()
+        except RuntimeError as msg:
+            print_debug("%s (ignored)" % msg)
+
+def adjust_mounted_image(g, roots, job, mounts=None):
+    try:
+        for (root, mount_points) in zip(roots, mounts or [None] * len(roots)):
+            guestfs_mount_root(g, root, plan_ops(job), mount_points=mount_points)
+        adjust_image(g, job)
+    except:
+        guestfs_abort(g)
+        raise
+    guestfs_unmount(g)
+
+def verify_image(g, job):
+    # what the guest is configured with, cross-checked against its domain XML
+    # and, when they are given, the options it was adjusted with
+    info = adjuster(gflags['os'], 'verify_image')(g)
+    udev = linux_read_udev_rules(g)
+    report = {'imgpath': job['imgpath'], 'xmlpath': job.get('xmlpath'), 'os': gflags['os'],
+              'problems': []}
+    report.update(info)
+    problems = report['problems']
+    xml_macs = []
+    if job.get('xmlpath'):
+        from lxml import etree
+        xml = etree.parse(job['xmlpath'], parser=etree.XMLParser())
+        xml_macs = [mac.lower() for mac in xml.xpath("/domain/devices/interface/mac/@address")]
+        sources = xml.xpath("/domain/devices/disk[@type='file' and @device='disk']/source/@file")
+        report['name'] = xml.xpath("string(/domain/name)")
+        report['uuid'] = xml.xpath("string(/domain/uuid)")
+        if gflags['backend'] != "local" and os.path.abspath(job['imgpath']) not in sources:
+            problems.append("disk source in XML is %s" % ", ".join(sources))
+    for i, xml_mac in enumerate(xml_macs):
+        ifname = "eth" + str(i)
+        iface = report['interfaces'].setdefault(ifname, {'mac': None, 'bootproto': None,
+                                                         'ipaddr': None, 'netmask': None})
+        iface['xml_mac'] = xml_mac
+        iface['udev_mac'] = udev.get(ifname)
+        if iface['mac'] and iface['mac'] != xml_mac:
+            problems.append("%s: MAC %s in guest, %s in XML" % (ifname, iface['mac'], xml_mac))
+        if iface['udev_mac'] and iface['udev_mac'] != xml_mac:
+            problems.append("%s: MAC %s in udev rules, %s in XML" % (ifname, iface['udev_mac'], xml_mac))
+    if job.get('interface'):
+        for (ifname, expected) in sorted(parse_interface_option(job['interface']).items()):
+            iface = report['interfaces'].get(ifname)
+            ipaddr = iface and (iface['ipaddr'] if iface['bootproto'] != "dhcp" else "dhcp")
+            if expected['ipaddr'] not in ("auto", ipaddr):
+                problems.append("%s: address %s in guest, %s expected" % (ifname, ipaddr, expected['ipaddr']))
+    if job.get('hostname') and report['hostname'] != job['hostname']:
+        problems.append("hostname %s in guest, %s expected" % (report['hostname'], job['hostname']))
+    if job.get('serial_console'):
+        for (name, configured) in report['serial_console'].items():
+            if not configured: problems.append("no serial console in %s" % name)
+    for problem in problems:
+        print "  ** %s" % problem
+    return report
+
+def verify_mounted_image(g, roots, job, mounts=None):
+    try:
+        for (root, mount_points) in zip(roots, mounts or [None] * len(roots)):
+            guestfs_mount_root(g, root, ['verify_image'], mount_points=mount_points)
+        report = verify_image(g, job)
+    finally:
+        guestfs_abort(g)
+    return report
+
+def verify_single_image(job):
+    g = guestfs_launch([job['imgpath']], readonly=True)
+    try:
+        return verify_mounted_image(g, g.inspect_os(), job)
+    finally:
+        g.close()
+
+def adjust_single_image(job):
+    g = guestfs_open(job['imgpath'], plan_ops(job))
+    try:
+        adjust_image(g, job)
+        guestfs_close(g)
+    finally:
+        g.close()
+
+def adjust_batch(jobs, max_drives, verify=False):
+    # attach up to max_drives images to one appliance, so that the launch and
+    # inspect_os() are paid once per group instead of once per clone. the
+    # filesystems of each image are mounted from its own drive, even when
+    # the clones share filesystem UUIDs (guestfs_drive_mountpoints()).
+    # with verify, the images are attached read-only and only inspected
+    (mounted_func, single_func) = (verify_mounted_image, verify_single_image) if verify else \
+                                  (adjust_mounted_image, adjust_single_image)
+    results = []
+    for start in range(0, len(jobs), max_drives):
+        group = jobs[start:start + max_drives]
+        print "=> batch: launching appliance for %d image(s)" % len(group)
+        try:
+            g = guestfs_launch([job['imgpath'] for job in group], readonly=verify)
+            print_debug("==> guestfs inspect_os()")
+            roots = {}
+            devices = g.list_devices()
+            for root in g.inspect_os():
+                roots.setdefault(guestfs_root_drive(g, root, devices), []).append(root)
+            partitions = guestfs_drive_partitions(g, devices) if len(group) > 1 else {}
+        except RuntimeError as e:
+            for job in group:
+                results.append(run_job(job, raise_error, e))
+            continue
+        leftovers = []
+        for i, job in enumerate(group):
+            if not roots.get(i):
+                # e.g. clones sharing an LVM VG name can't be activated together
+                leftovers.append((job, "no root found in shared appliance"))
+                continue
+            mounts = [guestfs_drive_mountpoints(g, root, i, devices, partitions) for root in roots[i]] \
+                if len(group) > 1 else None
+            if mounts and None in mounts:
+                leftovers.append((job, "logical volumes shared by name with another image"))
+                continue
+            print "=> batch: %s" % job['imgpath']
+            results.append(run_job(job, mounted_func, g, roots[i], job, mounts))
+        g.close()
+        for (job, reason) in leftovers:
+            print "=> batch: %s (%s, opening separately)" % (job['imgpath'], reason)
+            results.append(run_job(job, single_func, job))
+    return results
+
+def adjust_parallel(jobs, max_drives, nprocs, verify=False):
+    # every worker process owns its own appliance (guestfs handles are not
+    # thread-safe); jobs are handed out in groups so batch attach still applies
+    group_size = max(1, min(max_drives, (len(jobs) + nprocs - 1) // nprocs))
+    groups = [jobs[i:i + group_size] for i in range(0, len(jobs), group_size)]
+    import multiprocessing
+    pool = multiprocessing.Pool(processes=min(nprocs, len(groups)))
+    results = []
+    try:
+        for (group_results, profile) in pool.imap_unordered(adjust_batch_worker, [(group, max_drives, verify) for group in groups]):
+            results.extend(group_results)
+            if profile: gflags['profile'].merge(profile)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def adjust_batch_worker(args):
+    results = adjust_batch(*args)
+    return (results, gflags['profile'].take() if gflags['profile'] else None)
+
+def print_summary(results, elapsed):
+    failed = [r for r in results if r['status'] != 'ok']
+    print "=> summary: %d ok, %d failed, %.1f sec" % (len(results) - len(failed), len(failed), elapsed)
+    for r in sorted(results, key=lambda r: r['imgpath']):
+        print "  %-6s %8.1f sec  %s" % (r['status'], r['elapsed'], r['imgpath'])
+        if r['error']: print "         %s" % r['error']
+    return len(failed) == 0
+
+def image_format(imgpath):
+    out = subprocess.Popen(["qemu-img", "info", imgpath], stdout=subprocess.PIPE).communicate()[0]
+    m = re.search(r"^file format: (\S+)", out, re.M)
+    if not m:
+        raise RuntimeError("qemu-img info %s: unknown file format" % imgpath)
+    return m.group(1)
+
+def create_overlay(base_image, imgpath):
+    # qcow2 overlay backed by the golden image: only the blocks written by
+    # the adjuster (and later by the guest) are allocated in the clone
+    base_image = os.path.abspath(base_image)
+    base_format = image_format(base_image)
+    print "==> qcow2 overlay: %s (backing file: %s, %s)" % (imgpath, base_image, base_format)
+    # -b/-F instead of -o backing_file=...: -o splits on the commas a path can have
+    subprocess.check_call(["qemu-img", "create", "-q", "-f", "qcow2", "-b", base_image, "-F", base_format, imgpath])
+
+FICLONE = 0x40049409
+SEEK_DATA = 3
+SEEK_HOLE = 4
+COPY_CHUNK = 1024 * 1024
+
+def copy_range_kernel(libc, src, dst, offset, length):
+    # copy_file_range(2): the kernel copies (or shares) the blocks itself
+    import ctypes
+    off_in = ctypes.c_longlong(offset)
+    off_out = ctypes.c_longlong(offset)
+    while length > 0:
+        n = libc.copy_file_range(src, ctypes.byref(off_in), dst, ctypes.byref(off_out),
+                                 ctypes.c_size_t(min(length, 1 << 30)), 0)
+        if n < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        if n == 0:
+            break
+        length -= n
+    return off_out.value - offset
+
+def copy_range_user(src, dst, offset, length):
+    # read/write fallback; blocks of zeros inside data extents are skipped too
+    zeros = "\0" * COPY_CHUNK
+    written = 0
+    os.lseek(src, offset, os.SEEK_SET)
+    while length > 0:
+        buf = os.read(src, min(length, COPY_CHUNK))
+        if not buf:
+            break
+        if buf != zeros[:len(buf)]:
+            os.lseek(dst, offset, os.SEEK_SET)
+            os.write(dst, buf)
+            written += len(buf)
+        offset += len(buf)
+        length -= len(buf)
+    return written
+
+def data_extents(fd, size):
+    # (offset, length) of the data in a sparse file, by SEEK_DATA/SEEK_HOLE
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO: return
+            if e.errno == errno.EINVAL and offset == 0:
+                # not supported by the filesystem: the whole file is data
+                yield (0, size)
+                return
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield (start, end - start)
+        offset = end
+
+def fast_copy_fd(src, dst):
+    size = os.fstat(src).st_size
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        return ("reflink", 0)
+    except IOError as e:
+        print_debug("  FICLONE: %s" % e)
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    method = "copy_file_range" if hasattr(libc, "copy_file_range") else "read/write"
+    written = 0
+    for (offset, length) in data_extents(src, size):
+        if method == "copy_file_range":
+            try:
+                written += copy_range_kernel(libc, src, dst, offset, length)
+                continue
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                print_debug("  copy_file_range: %s" % e)
+                method = "read/write"
+        written += copy_range_user(src, dst, offset, length)
+    os.ftruncate(dst, size)
+    os.fsync(dst)
+    return (method, written)
+
+def fast_copy(src_path, dst_path):
+    # full copy of an image: a reflink (FICLONE) where the filesystem shares
+    # extents (XFS, btrfs), else only the data extents of the source are
+    # copied, with copy_file_range(2) if the kernel has it, so holes stay
+    # holes and no zeros are written. returns (method, bytes written).
+    src = os.open(src_path, os.O_RDONLY)
+    try:
+        dst = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        try:
+            return fast_copy_fd(src, dst)
+        except:
+            os.unlink(dst_path)
+            raise
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+def full_copy(base_image, imgpath):
+    print "==> full copy: %s (from %s)" % (imgpath, base_image)
+    start = time.time()
+    (method, written) = fast_copy(base_image, imgpath)
+    size = os.path.getsize(imgpath)
+    print "  %s: %d of %d bytes written, %.1f sec" % (method, written, size, time.time() - start)
+
+def job_xml_template(job):
+    # a clone is instantiated from the golden XML, parsed once per batch
+    return job['base_xml'] if job.get('base_image') else job['xmlpath']
+
+def clone_image(job):
+    print_debug("==> clone_image(): %s" % job)
+    if not (job.get('base_image') and job.get('base_xml') and job.get('imgpath') and job.get('xmlpath')):
+        raise RuntimeError("clone needs --base-image, --base-xml, --image and --xml")
+    for path in (job['imgpath'], job['xmlpath']):
+        if os.path.exists(path):
+            raise RuntimeError("%s already exists" % path)
+    # --xml is written from the golden XML by adjust_xml()
+    if job.get('full_copy'):
+        full_copy(job['base_image'], job['imgpath'])
+        job['image_format'] = image_format(job['imgpath'])
+    else:
+        create_overlay(job['base_image'], job['imgpath'])
+        job['image_format'] = "qcow2"
+
+class pipeline_stage:
+    # one stage of the clone pipeline: `workers` threads take jobs from a
+    # bounded queue, run func(job) and hand the job to the next stage, so a
+    # slow stage holds back the ones before it instead of piling up jobs
+    def __init__(self, name, func, workers, queue_size):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.results = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.done = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.first = None
+        self.last = None
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.run, name="%s-%d" % (self.name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                # the end marker is put back for the other workers of the stage
+                self.queue.put(None)
+                return
+            start = time.time()
+            error = None
+            try:
+                self.func(job)
+            except (Exception, SystemExit) as e:
+                print "** %s: %s: %s" % (self.name, job.get('imgpath'), e)
+                error = "%s: %s: %s" % (self.name, e.__class__.__name__, e)
+            end = time.time()
+            with self.lock:
+                self.busy += end - start
+                self.first = start if self.first is None else min(self.first, start)
+                self.last = end if self.last is None else max(self.last, end)
+                if error: self.failed += 1
+                else: self.done += 1
+            if error or self.next is None:
+                self.results.append({'imgpath': job.get('imgpath'), 'status': 'failed' if error else 'ok',
+                                     'error': error, 'elapsed': end - job['pipeline_start']})
+            else:
+                self.next.queue.put(job)
+
+    def join(self):
+        for t in self.threads:
+            # join() with a timeout keeps the main thread interruptible
+            while t.is_alive():
+                t.join(1)
+
+    def report(self):
+        span = (self.last - self.first) if self.first is not None else 0.0
+        return "  %-7s %7d %5d %6d %9.1f %9.2f %10.0f%%" % (
+            self.name, self.workers, self.done, self.failed, self.busy,
+            self.done / span if span else 0.0, 100.0 * self.busy / (span * self.workers) if span else 0.0)
+
+def run_pipeline(jobs, stages):
+    results = []
+    for (stage, next_stage) in zip(stages, stages[1:] + [None]):
+        stage.next = next_stage
+        stage.results = results
+        stage.start()
+    for job in jobs:
+        job['pipeline_start'] = time.time()
+        stages[0].queue.put(job)
+    stages[0].queue.put(None)
+    for (stage, next_stage) in zip(stages, stages[1:] + [None]):
+        stage.join()
+        if next_stage: next_stage.queue.put(None)
+    print "=> pipeline"
+    print "  %-7s %7s %5s %6s %9s %9s %11s" % ("stage", "workers", "done", "failed", "busy sec", "jobs/sec", "utilization")
+    for stage in stages:
+        print stage.report()
+    return results
+
+def pipeline_adjust_worker(job):
+    result = run_job(job, daemon_adjust, job)
+    return (result, gflags['profile'].take() if gflags['profile'] else None)
+
+def clone_pipeline(options, jobs):
+    # copy/overlay, guest adjust, XML render and define run as separate stages
+    # joined by bounded queues, so clone N+1 is being created while clone N is
+    # adjusted. guestfs work runs in worker processes with warm appliances
+    # (as in the daemon); the other stages are threads of this process.
+    limits = {'copy': 2, 'adjust': options.jobs, 'xml': 1, 'define': 1}
+    if options.stage_jobs:
+        for limit in options.stage_jobs.split(","):
+            (name, n) = limit.split("=")
+            if name not in limits:
+                raise RuntimeError("--stage-jobs: unknown stage: %s" % name)
+            limits[name] = int(n)
+    # in seed mode the adjust stage only writes the seed ISO
+    import multiprocessing
+    pool = multiprocessing.Pool(processes=limits['adjust'], initializer=daemon_worker_init) \
+        if options.mode != "seed" else None
+    conn = libvirt_open(options.define) if options.define else None
+
+    def adjust(job):
+        job['defer_xml'] = True
+        (result, profile) = pool.apply(pipeline_adjust_worker, (job,))
+        if profile: gflags['profile'].merge(profile)
+        if result['error']:
+            raise RuntimeError(result['error'])
+
+    def render_xml(job):
+        adjust_xml(job['xmlpath'], template=domain_template.load(job_xml_template(job)),
+                   image=job['imgpath'], uuid=job['uuid'], macs=job['macs'], format=job.get('image_format'),
+                   seed=job.get('seed'))
+
+    stages = [pipeline_stage('copy', clone_image, limits['copy'], options.queue_size),
+              pipeline_stage('adjust', adjust if pool else make_seed, limits['adjust'], options.queue_size),
+              pipeline_stage('xml', render_xml, limits['xml'], options.queue_size)]
+    if conn:
+        stages.append(pipeline_stage('define', lambda job: define_domain(conn, job['xmlpath']),
+                                     limits['define'], options.queue_size))
+    start = time.time()
+    try:
+        results = run_pipeline(jobs, stages)
+        if pool: pool.close()
+    except KeyboardInterrupt:
+        if pool: pool.terminate()
+        raise
+    finally:
+        if pool: pool.join()
+        if conn: conn.close()
+    return 0 if print_summary(results, time.time() - start) else 1
+
+def load_manifest(parser, path, defaults):
+    # one clone per line, written with the same options as the command line.
+    # options given on the command line are used as defaults for every line.
+    jobs = []
+    for line in open(path, 'r'):
+        line = line.strip()
+        if not line or line.startswith("#"): continue
+        (opts, args) = parser.parse_args(shlex.split(line), values=copy.copy(defaults))
+        jobs.append(vars(opts))
+    return jobs
+
+daemon_worker = {'g': None, 'drives': 0}
+
+def guestfs_launch_warm():
+    # an appliance launched without drives; images are hotplugged into it
+    # per job (needs a libguestfs with hotplug support, i.e. the libvirt backend)
+    try:
+        g = guestfs_handle()
+        g.set_autosync(1)
+        g.set_selinux(1)
+        g.launch()
+        return g
+    except RuntimeError as msg:
+        print "** warm appliance not available, every job launches its own: %s" % msg
+        return None
+
+def daemon_worker_init(profile=False):
+    # profile: every job takes the calls it made (daemon), as --profile of
+    # the command that submitted it decides whether they are reported
+    if profile: gflags['profile'] = profiler()
+    daemon_worker['g'] = guestfs_launch_warm()
+
+def daemon_adjust(job):
+    if job.get('command') == 'clone':
+        clone_image(job)
+    if job.get('mode') == "seed":
+        seed_image(job)
+        return
+    g = daemon_worker['g'] if gflags['backend'] == "guestfs" else None
+    if g is not None:
+        label = "job%d" % daemon_worker['drives']
+        daemon_worker['drives'] += 1
+        try:
+            g.add_drive_opts(job['imgpath'], readonly=1 if gflags['dry_run'] else 0, label=label)
+        except (RuntimeError, TypeError) as msg:
+            print "** hotplug failed, falling back to a new appliance per job: %s" % msg
+            g.close()
+            g = daemon_worker['g'] = None
+    if g is None:
+        adjust_single_image(job)
+        return
+    try:
+        adjust_mounted_image(g, g.inspect_os(), job)
+    finally:
+        g.remove_drive(label)
+
+def daemon_run_job(job):
+    # a job runs with the flags of the command that submitted it, not with
+    # those the daemon was started with
+    saved = dict(gflags)
+    gflags['debug'] = job.get('debug')
+    gflags['dry_run'] = job.get('dry_run')
+    gflags['backend'] = job.get('backend') or "guestfs"
+    gflags['profile'].take()
+    try:
+        result = run_job(job, daemon_adjust, job)
+        profile = gflags['profile'].take()
+        if job.get('profile'): result['profile'] = profile
+    finally:
+        gflags.update(saved)
+    return result
+
+def daemon_handle(conn, pool):
+    # one JSON job per line; a JSON result per line is sent back as each job finishes
+    try:
+        jobs = []
+        for line in conn.makefile('r'):
+            if not line.strip(): continue
+            try:
+                jobs.append(json.loads(line))
+            except ValueError as e:
+                conn.sendall(json.dumps({'imgpath': None, 'status': 'failed', 'elapsed': 0.0,
+                                         'error': "bad request: %s" % e}) + "\n")
+        print "=> daemon: %d job(s) received" % len(jobs)
+        for result in pool.imap_unordered(daemon_run_job, jobs):
+            conn.sendall(json.dumps(result) + "\n")
+    except socket.error as msg:
+        print "** daemon: client went away: %s" % msg
+    finally:
+        conn.close()
+
+def command_daemon(options, args, jobs):
+    import multiprocessing
+    pool = multiprocessing.Pool(processes=options.jobs, initializer=daemon_worker_init, initargs=(True,))
+    if os.path.exists(options.socket):
+        os.unlink(options.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(options.socket)
+    os.chmod(options.socket, 0600)
+    server.listen(16)
+    print "=> daemon: listening on %s with %d worker(s)" % (options.socket, options.jobs)
+    try:
+        while True:
+            (conn, addr) = server.accept()
+            t = threading.Thread(target=daemon_handle, args=(conn, pool))
+            t.daemon = True
+            t.start()
+    except KeyboardInterrupt:
+        print "=> daemon: shutting down"
+        pool.terminate()
+    finally:
+        server.close()
+        os.unlink(options.socket)
+    return 0
+
+def command_submit(options, args, jobs):
+    # the daemon runs in its own working directory, so paths are sent absolute
+    command = args[0] if args else "adjust"
+    if command not in ("adjust", "clone"):
+        raise RuntimeError("submit: unknown command: %s" % command)
+    if command == "clone":
+        check_clone_options(options)
+    start = time.time()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(options.socket)
+    for job in jobs:
+        job['command'] = command
+        for key in ('imgpath', 'xmlpath', 'base_image', 'base_xml', 'network_layout'):
+            if job.get(key): job[key] = os.path.abspath(job[key])
+        client.sendall(json.dumps(job) + "\n")
+    client.shutdown(socket.SHUT_WR)
+    results = []
+    for line in client.makefile('r'):
+        result = json.loads(line)
+        profile = result.pop('profile', None)
+        if profile and gflags['profile']: gflags['profile'].merge(profile)
+        print "  %-6s %8.1f sec  %s" % (result['status'], result['elapsed'], result['imgpath'])
+        results.append(result)
+    client.close()
+    return 0 if print_summary(results, time.time() - start) else 1
 
 class MyOptionParser(optparse.OptionParser):
     def format_epilog(self, formatter):
         return self.epilog
 
-    usage = "%prog [--image IMAGEPATH] [--xml XMLPATH] [--interface INTERFACE_DESCRIPTION] [--primary INTERFACE] [--gateway IPADDRESS] [--nameserver NAMESERVERS] [--domain DOMAINS] [--hostname HOSTNAME] [--serial-console] [--debug]"
+    usage = "%prog [adjust|clone|verify|prepare-base|rollback|daemon|submit [adjust|clone]] [--image IMAGEPATH] [--xml XMLPATH] [--interface INTERFACE_DESCRIPTION | --network-layout FILE] [--primary INTERFACE] [--gateway IPADDRESS] [--nameserver NAMESERVERS] [--domain DOMAINS] [--hostname HOSTNAME] [--serial-console] [--base-image IMAGEPATH --base-xml XMLPATH [--full-copy]] [--batch MANIFEST [--batch-drives N] [--jobs N]] [--pipeline [--stage-jobs LIMITS] [--queue-size N]] [--mode image|seed] [--backend guestfs|local] [--dry-run] [--state FILE [--xml-dir DIR] [--ip-pool POOLS]] [--define URI] [--report FILE] [--journal NAME] [--socket PATH] [--profile FILE] [--debug]"
     epilog = """
 Example:
 If you are going to set the following parameters to test.img and test.xml:
@@ -566,49 +2964,254 @@ Run this script like this:
 --domain=dept.example.com,example.com
 """
 
-if __name__ == '__main__':
+def build_option_parser():
     #parser = optparse.OptionParser(usage=usage)
     parser = MyOptionParser(usage=MyOptionParser.usage, epilog=MyOptionParser.epilog)
     parser.add_option("--image", action="store", dest="imgpath", help="path of image file")
     parser.add_option("--xml", action="store", dest="xmlpath", help="path of XML file")
-    parser.add_option("--interface", action="store", dest="interface", help="specifies interface infomation. the format of an interface is \"IFNAME/MAC/IPADDR/NETMASK\". use \"auto\" for MAC to be autogenerated. for DHCP, use \"dhcp\" in IPADDR. you can specify multiple interfaces separated by comma (',').")
+    parser.add_option("--interface", action="store", dest="interface", help="specifies interface infomation. the format of an interface is \"IFNAME/MAC/IPADDR/NETMASK\". use \"auto\" for MAC to be autogenerated. for DHCP, use \"dhcp\" in IPADDR. use \"auto\" for IPADDR and NETMASK to take the next free address of --ip-pool. you can specify multiple interfaces separated by comma (',').")
+    parser.add_option("--network-layout", action="store", dest="network_layout", help="JSON file describing the guest interfaces (ethernet, bond, vlan, bridge) instead of --interface. ethernet interfaces are matched to the domain XML by \"mac\" and get the new MAC of that NIC. the network configuration files are rendered from it and written in one pass.")
     parser.add_option("--primary", action="store", dest="primary", help="specifies primary interface. settings of gateway, DNS, etc are written in this interface config file.")
     parser.add_option("--gateway", action="store", dest="gateway", help="default gateway")
     parser.add_option("--nameserver", action="store", dest="nameserver", help="DNS nameservers.")
     parser.add_option("--domain", action="store", dest="domain", help="DNS search domains.")
     parser.add_option("--hostname", action="store", dest="hostname", help="hostname")
     parser.add_option("--serial-console", action="store_true", dest="serial_console", help="serial console config for \"virsh console\".")
+    parser.add_option("--batch", action="store", dest="batch", help="manifest file of clones to adjust, one clone per line with the options above (--image, --xml, --interface, ...). options on the command line are used as defaults for every line.")
+    parser.add_option("--batch-drives", action="store", type="int", dest="batch_drives", default=8, help="number of images attached to one appliance in batch mode (default: 8).")
+    parser.add_option("--jobs", action="store", type="int", dest="jobs", default=1, help="number of worker processes in batch and daemon mode, each with its own appliance (default: 1).")
+    parser.add_option("--base-image", action="store", dest="base_image", help="clone: golden image the new qcow2 overlay (--image) is backed by.")
+    parser.add_option("--base-xml", action="store", dest="base_xml", help="clone: XML file of the golden image, --xml is written from it.")
+    parser.add_option("--mode", action="store", dest="mode", type="choice", choices=["image", "seed"], default="image", help="image: edit the image offline (default). seed: leave the image alone and write a cloud-init NoCloud seed ISO (XMLPATH with .seed.iso) with the network, hostname and DNS settings, attached to the domain as a cdrom.")
+    parser.add_option("--backend", action="store", dest="backend", type="choice", choices=["guestfs", "local"], default="guestfs", help="guestfs: edit the image through a libguestfs appliance (default). local: --image is a root tree on the host (extracted or mounted template), edited in place.")
+    parser.add_option("--dry-run", action="store_true", dest="dry_run", help="print the changes that would be made, without writing anything (images are opened read-only).")
+    parser.add_option("--full-copy", action="store_true", dest="full_copy", help="clone: make --image an independent copy of --base-image instead of a qcow2 overlay (reflinked where the filesystem supports it, holes are preserved).")
+    parser.add_option("--pipeline", action="store_true", dest="pipeline", help="clone: run the copy, adjust, XML and define stages of the clones in a pipeline, so that they overlap.")
+    parser.add_option("--stage-jobs", action="store", dest="stage_jobs", help="clone --pipeline: workers per stage, \"STAGE=N\" separated by comma (','). stages are copy (default: 2), adjust (default: --jobs), xml (default: 1) and define (default: 1).")
+    parser.add_option("--queue-size", action="store", type="int", dest="queue_size", default=4, help="clone --pipeline: number of clones waiting in front of each stage (default: 4).")
+    parser.add_option("--state", action="store", dest="state", help="allocation index (JSON) of the MACs, UUIDs and pool IPs in use, locked while in use and updated by every run. built from the domain XMLs in --xml-dir on first use.")
+    parser.add_option("--xml-dir", action="store", dest="xml_dir", default="/etc/libvirt/qemu", help="directory of the libvirt domain XMLs indexed in --state (default: /etc/libvirt/qemu). only new or changed files are parsed again.")
+    parser.add_option("--ip-pool", action="store", dest="ip_pool", help="address pools for \"auto\" in IPADDR/NETMASK of --interface, \"IFNAME=NETWORK/PREFIX\", separated by comma (','). needs --state.")
+    parser.add_option("--define", action="store", dest="define", help="define the adjusted domains through this libvirt connection URI (e.g. qemu:///system), one connection for the whole batch. needs libvirt-python.")
+    parser.add_option("--report", action="store", dest="report", help="verify: write the report to this file, CSV if it ends with \".csv\", JSON otherwise (\"-\" for stdout).")
+    parser.add_option("--journal", action="store", dest="journal", help="rollback: name of the undo journal in the guest to roll back (default: the last one).")
+    parser.add_option("--socket", action="store", dest="socket", default="/var/run/kvm_image_adjuster.sock", help="daemon/submit: path of the UNIX domain socket (default: /var/run/kvm_image_adjuster.sock).")
+    parser.add_option("--profile", action="store", dest="profile", help="write a JSON report of the wall time per phase and the count/latency per guestfs call to this file (\"-\" for stdout).")
     parser.add_option("--debug", action="store_true", dest="debug")
     #group = OptionGroup(parser, "Example", "./kvm_image_adjuster.py --image=./test.img --xml=./test.xml --interface=eth0/auto/10.7.9.100/255.255.0.0,eth1/auto/dhcp/dhcp --primary=eth0 --gateway=10.0.0.1 --hostname=vm.example.com --nameserver=8.8.8.8,8.8.4.4 --domain=dept.example.com,example.com")
     #parser.add_option_group(group)
-    (options, args) = parser.parse_args()
-    gflags['debug'] = options.debug
+    return parser
 
-    g = guestfs_open(options.imgpath)
-    if options.debug: guestfs_print_misc(g)
-    OS = gflags['os']
+def command_adjust(options, args, jobs):
+    if options.mode == "seed":
+        return command_seed(options, args, jobs)
+    if not options.batch:
+        g = guestfs_open(jobs[0]['imgpath'], plan_ops(jobs[0]))
+        if options.debug: guestfs_print_misc(g)
+        adjust_image(g, jobs[0])
+        guestfs_close(g)
+        if options.define and not options.dry_run:
+            define_domains(options.define, [jobs[0]['xmlpath']])
+        return 0
 
-    if options.interface:
-        defined_macs = get_all_macs_from_xml(options.xmlpath)
-        new_ifaces = parse_interface_option(options.interface)
-        new_macs = generate_new_macs(defined_macs, new_ifaces)
-        nameservers = options.nameserver.split(",") if options.nameserver else None
-        domains = options.domain.split(",") if options.domain else None
+    start = time.time()
+    if options.jobs > 1:
+        results = adjust_parallel(jobs, options.batch_drives, options.jobs)
+    else:
+        results = adjust_batch(jobs, options.batch_drives)
+    ok = print_summary(results, time.time() - start)
+    if options.define and not options.dry_run:
+        adjusted = set([r['imgpath'] for r in results if r['status'] == 'ok'])
+        define_domains(options.define, [job['xmlpath'] for job in jobs if job['imgpath'] in adjusted])
+    return 0 if ok else 1
 
-        print "=> adjust interfaces (img)"
-        adjuster(OS, 'adjust_ifaces')(g, defined_macs, new_ifaces, new_macs,
-                                      nameservers, domains, options.primary, options.gateway)
-        adjuster(OS, 'adjust_udev_rules')(g, ifcfgs)
-        adjuster(OS, 'adjust_hostname')(g, options.hostname)
-        adjuster(OS, 'adjust_resolvconf')(g, nameservers, domains)
-        print "=> adjust interfaces (xml)"
-        adjuster(OS, 'adjust_xml')(options.xmlpath, image=options.imgpath, uuid=generate_new_uuid(), macs=new_macs)
-        adjuster(OS, 'adjust_misc')(g)
+def check_fleet(reports):
+    # MACs and static addresses must also be unique across the images
+    owners = {}
+    for report in reports:
+        for (ifname, iface) in report['interfaces'].items():
+            for key in ('xml_mac', 'ipaddr'):
+                if iface.get(key) and not (key == 'ipaddr' and iface['bootproto'] == "dhcp"):
+                    owners.setdefault(iface[key], []).append(report)
+    for (value, reports) in owners.items():
+        if len(reports) > 1:
+            for report in reports:
+                report['problems'].append("%s is also used by %s" %
+                                          (value, ", ".join([r['imgpath'] for r in reports if r is not report])))
+
+def write_verify_report(path, reports):
+    if path.endswith(".csv"):
+        f = open(path, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(["imgpath", "xmlpath", "status", "os", "hostname", "interface", "xml_mac", "mac",
+                         "udev_mac", "bootproto", "ipaddr", "netmask", "nameservers", "grub_console",
+                         "getty", "problems"])
+        for report in reports:
+            common = [report['imgpath'], report.get('xmlpath'), report['status']]
+            if report['status'] == 'failed':
+                writer.writerow(common + [""] * 12 + [report['error']])
+                continue
+            for ifname in sorted(report['interfaces']) or [None]:
+                iface = report['interfaces'].get(ifname, {})
+                writer.writerow(common + [report['os'], report['hostname'], ifname] +
+                                [iface.get(key) for key in ('xml_mac', 'mac', 'udev_mac', 'bootproto', 'ipaddr', 'netmask')] +
+                                [" ".join(report['nameservers']), report['serial_console']['grub'],
+                                 report['serial_console']['getty'], "; ".join(report['problems'])])
+        f.close()
+        return
+    content = json.dumps(reports, indent=2, sort_keys=True)
+    if path == "-": print content
+    else: open(path, 'w').write(content + "\n")
+
+def command_verify(options, args, jobs):
+    start = time.time()
+    if options.jobs > 1:
+        results = adjust_parallel(jobs, options.batch_drives, options.jobs, verify=True)
+    else:
+        results = adjust_batch(jobs, options.batch_drives, verify=True)
+    reports = [r['report'] for r in results if r['status'] == 'ok']
+    check_fleet(reports)
+    summary = []
+    for r in sorted(results, key=lambda r: r['imgpath']):
+        if r['status'] == 'ok':
+            report = r['report']
+            report['status'] = 'mismatch' if report['problems'] else 'ok'
+        else:
+            report = {'imgpath': r['imgpath'], 'status': r['status'], 'error': r['error']}
+        summary.append(report)
+    counts = dict([(status, len([r for r in summary if r['status'] == status])) for status in ('ok', 'mismatch', 'failed')])
+    print "=> verify: %d ok, %d mismatch, %d failed, %.1f sec" % (counts['ok'], counts['mismatch'], counts['failed'],
+                                                                 time.time() - start)
+    for report in summary:
+        print "  %-8s %s" % (report['status'], report['imgpath'])
+        for problem in report.get('problems', []) + ([report['error']] if report.get('error') else []):
+            print "           %s" % problem
+    if options.report:
+        write_verify_report(options.report, summary)
+    return 0 if counts['ok'] == len(summary) else 1
 
+def guestfs_journals(g):
+    # undo journals of the image, oldest first
+    if not g.is_dir(JOURNAL_DIR):
+        return []
+    return ["%s/%s" % (JOURNAL_DIR, name) for name in sorted(g.ls(JOURNAL_DIR)) if name.endswith(".json.gz")]
+
+def guestfs_rollback(g, path):
+    # checks every file of the journal first, then restores them all; a file
+    # changed after the run (e.g. by the guest) stops the rollback
+    journal = json.loads(gzip.GzipFile(fileobj=StringIO.StringIO(g.read_file(path))).read())
+    print "==> rollback: %s (%s, %d file(s))" % (path, journal['time'], len(journal['files']))
+    restore = {}
+    for (filepath, entry) in sorted(journal['files'].items()):
+        filepath = str(filepath)
+        current = g.read_file(filepath) if g.is_file(filepath) else None
+        if (hashlib.sha1(current).hexdigest() if current is not None else None) != entry['sha1']:
+            raise RuntimeError("%s has changed since %s, not rolling back" % (filepath, journal['time']))
+        restore[filepath] = None if entry.get('created') else journal_undo(current or "", entry['delta'])
+    restored = []
+    for (filepath, content) in sorted(restore.items()):
+        print "  %s %s" % ("remove " if content is None else "restore", filepath)
+        if gflags['dry_run']: continue
+        if content is None:
+            g.rm_f(filepath)
+        else:
+            g.write(filepath, content)
+            restored.append(filepath)
+    if gflags['dry_run']:
+        return
+    guestfs_relabel(g, restored)
+    # last, so that a rollback that stops early can be run again
+    g.rm_f(path)
+
+def command_rollback(options, args, jobs):
+    # undoes the last run on the image (or --journal), with its XML
+    if options.batch:
+        raise RuntimeError("rollback works on one image (--image)")
+    job = jobs[0]
+    g = guestfs_open(job['imgpath'], ['rollback'], use_base=False)
+    journals = guestfs_journals(g)
+    if options.journal:
+        journals = [path for path in journals if os.path.basename(path) in (options.journal, options.journal + ".json.gz")]
+    if not journals:
+        print "** no undo journal found in %s" % job['imgpath']
+        guestfs_close(g)
+        return 1
+    guestfs_rollback(g, journals[-1])
+    guestfs_close(g)
+    orig_xmlfile = (job.get('xmlpath') or "") + ".orig"
+    if job.get('xmlpath') and os.path.exists(orig_xmlfile):
+        print "==> XML: %s => %s" % (orig_xmlfile, job['xmlpath'])
+        if not options.dry_run:
+            os.rename(orig_xmlfile, job['xmlpath'])
+    return 0
+
+def command_seed(options, args, jobs):
+    # no appliance: every clone gets a NoCloud seed ISO and its XML
     if options.serial_console:
-        print "=> adjust for serial console"
-        adjuster(OS, 'adjust_grub')(g)
-        adjuster(OS, 'adjust_upstart')(g)
-        adjuster(OS, 'adjust_inittab')(g)
+        print "** --serial-console is not applied in seed mode, prepare the golden image with prepare-base"
+    start = time.time()
+    results = [run_job(job, seed_image, job) for job in jobs]
+    ok = print_summary(results, time.time() - start) if options.batch else results[0]['status'] == 'ok'
+    if options.define and not options.dry_run:
+        adjusted = set([r['imgpath'] for r in results if r['status'] == 'ok'])
+        define_domains(options.define, [job['xmlpath'] for job in jobs if job['imgpath'] in adjusted])
+    return 0 if ok else 1
 
+def command_prepare_base(options, args, jobs):
+    # applies the clone-invariant operations to the golden image once
+    if options.batch:
+        raise RuntimeError("prepare-base works on one image (--image)")
+    g = guestfs_open(jobs[0]['imgpath'], base_plan_ops(jobs[0]), use_base=False)
+    prepare_base_image(g, jobs[0])
     guestfs_close(g)
+    return 0
+
+def check_clone_options(options):
+    if options.backend != "guestfs":
+        raise RuntimeError("clone creates qcow2 overlays, it needs the guestfs backend")
+    if options.dry_run:
+        raise RuntimeError("clone can't be run with --dry-run")
+
+def command_clone(options, args, jobs):
+    check_clone_options(options)
+    if options.pipeline:
+        return clone_pipeline(options, jobs)
+    for job in jobs:
+        clone_image(job)
+    return command_adjust(options, args, jobs)
+
+commands = {
+    'adjust': command_adjust,
+    'clone': command_clone,
+    'daemon': command_daemon,
+    'verify': command_verify,
+    'prepare-base': command_prepare_base,
+    'rollback': command_rollback,
+    'submit': command_submit,
+}
+
+if __name__ == '__main__':
+    parser = build_option_parser()
+    (options, args) = parser.parse_args()
+    gflags['debug'] = options.debug
+    if options.profile: gflags['profile'] = profiler()
+    gflags['backend'] = options.backend
+    gflags['dry_run'] = options.dry_run
+
+    command = args[0] if args else "adjust"
+    if command not in commands:
+        parser.error("unknown command: %s" % command)
+    jobs = load_manifest(parser, options.batch, options) if options.batch else [vars(options)]
+    try:
+        if command not in ("daemon", "verify", "prepare-base", "rollback"):
+            allocate(options, jobs)
+        ret = commands[command](options, args[1:], jobs)
+    except RuntimeError as msg:
+        if options.debug: raise
+        print "** %s" % msg
+        sys.exit(1)
+    if options.profile:
+        report = gflags['profile'].report()
+        if options.profile == "-": print report
+        else: open(options.profile, 'w').write(report + "\n")
+    sys.exit(ret)
@@ -11,5 +11,5 @@ dstname=$1; shift
 datadir=.
 
 for ext in img xml; do
-	/bin/cp ${datadir}/${srcname}.${ext} ${datadir}/${dstname}.${ext}
+	/bin/cp --reflink=auto --sparse=always ${datadir}/${srcname}.${ext} ${datadir}/${dstname}.${ext}
 done